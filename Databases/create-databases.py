@@ -1,11 +1,10 @@
 import sqlite3
+import sys
 
-def create_cities_table():
+def create_cities_table(cursor):
     '''
     Creates a table to store which cities have already been scraped
     '''
-    conn = sqlite3.connect('travel.db')
-    cursor = conn.cursor()
 
     # Create the table with the required fields
     sql_command = f"CREATE TABLE IF NOT EXISTS cities (     \
@@ -16,15 +15,11 @@ def create_cities_table():
 
     # Execute the SQL command
     cursor.execute(sql_command)
-    conn.commit()
-    conn.close()
 
-def create_places_table():
+def create_places_table(cursor):
     '''
     Creating a table to store the places that have already been scraped
     '''
-    conn = sqlite3.connect('travel.db')
-    cursor = conn.cursor()
 
     # Create places table
     sql_command = f"CREATE TABLE IF NOT EXISTS places (              \
@@ -45,15 +40,11 @@ def create_places_table():
                     )"
     
     cursor.execute(sql_command)
-    conn.commit()
-    conn.close()
 
-def create_time_table():
+def create_time_table(cursor):
     '''
     Creating a table to store the opening and closing times of the places
     '''
-    conn = sqlite3.connect('travel.db')
-    cursor = conn.cursor()
 
     # Create the table with the required fields
     sql_command = f"CREATE TABLE IF NOT EXISTS time (               \
@@ -69,70 +60,287 @@ def create_time_table():
 
     # Execute the SQL command
     cursor.execute(sql_command)
-    conn.commit()
-    conn.close()
 
-def create_photos_table():
+def create_photos_table(cursor):
     '''
     Creating a table to store the photos of the places
     '''
-    conn = sqlite3.connect('travel.db')
-    cursor = conn.cursor()
 
     # Create the table with the required fields
     sql_command = f"CREATE TABLE IF NOT EXISTS photos (             \
                     id INTEGER PRIMARY KEY,                         \
-                    photo TEXT,                                     \
+                    photo_reference TEXT NULL,                      \
+                    height INTEGER NULL,                            \
+                    width INTEGER NULL,                             \
                     place_id TEXT,                                  \
                     FOREIGN KEY (place_id) REFERENCES places(id)    \
                     )"
 
     # Execute the SQL command
     cursor.execute(sql_command)
-    conn.commit()
-    conn.close()
 
-def create_photos_table():
-    conn = sqlite3.connect('travel.db')
-    cursor = conn.cursor()
+def create_place_categories_table(cursor):
+    '''
+    Creates a table with one row per (place, category) pair
+    Indexed both ways so filtering by category and listing the categories of a place are index lookups
+    '''
 
-    # Create the table with the required fields
-    sql_command = f"CREATE TABLE IF NOT EXISTS photos (             \
-                    id INTEGER PRIMARY KEY,                         \
-                    photo_reference TEXT NULL,                      \
-                    height INTEGER NULL,                            \
-                    width INTEGER NULL,                             \
+    sql_command = f"CREATE TABLE IF NOT EXISTS place_categories (      \
+                    place_id TEXT,                                  \
+                    category TEXT,                                  \
+                    PRIMARY KEY (place_id, category),               \
+                    FOREIGN KEY (place_id) REFERENCES places(id)    \
+                    ) WITHOUT ROWID"
+    cursor.execute(sql_command)
+    cursor.execute("CREATE INDEX IF NOT EXISTS place_categories_category ON place_categories (category, place_id)")
+
+def migrate_category_table(cursor):
+    '''
+    Copies the old categories table (one column per category) into place_categories
+    '''
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'categories'")
+    if cursor.fetchone():
+        cursor.execute("PRAGMA table_info(categories)")
+        categories = [column[1] for column in cursor.fetchall() if column[1] != 'place_id']
+
+        for category in categories:
+            cursor.execute(f"INSERT OR IGNORE INTO place_categories (place_id, category) SELECT place_id, ? FROM categories WHERE \"{category}\" = 1", (category,))
+
+def add_opening_window_columns(cursor):
+    '''
+    Adds the daily opening window (minutes of the day) to the places table
+    '''
+
+    cursor.execute("PRAGMA table_info(places)")
+    columns = [column[1] for column in cursor.fetchall()]
+    for column in ['open_minute', 'close_minute']:
+        if column not in columns:
+            cursor.execute(f"ALTER TABLE places ADD COLUMN {column} INTEGER NULL")
+
+def add_visit_minutes_column(cursor):
+    '''
+    Adds the average visit time of the place (from its categories) to the places table
+    Places scraped before it existed are averaged from place_categories when they are queried
+    '''
+
+    cursor.execute("PRAGMA table_info(places)")
+    if 'visit_minutes' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE places ADD COLUMN visit_minutes REAL NULL")
+
+def create_opening_intervals_table(cursor):
+    '''
+    Creating a table to store the opening intervals of the places in minutes of the week (Monday 00:00 is 0)
+    '''
+
+    sql_command = f"CREATE TABLE IF NOT EXISTS opening_intervals (  \
                     place_id TEXT,                                  \
+                    start_minute INTEGER,                           \
+                    end_minute INTEGER,                             \
                     FOREIGN KEY (place_id) REFERENCES places(id)    \
                     )"
+    cursor.execute(sql_command)
+    cursor.execute("CREATE INDEX IF NOT EXISTS opening_intervals_place_id ON opening_intervals (place_id, start_minute)")
 
-    # Execute the SQL command
+def backfill_opening_windows(cursor):
+    '''
+    Computes the opening intervals and daily window of the places scraped before they existed
+    Same rules as opening_window in data_scraper.py
+    '''
+
+    # Closed days (all zeros) and unknown hours (NULL) have no interval, closing before opening means after midnight
+    sql_command = f"INSERT INTO opening_intervals (place_id, start_minute, end_minute)                                   \
+                    SELECT place_id, day_start + open, day_start + CASE WHEN close <= open THEN close + 1440 ELSE close END \
+                    FROM (                                                                                              \
+                        SELECT place_id, open_hour * 60 + open_minute AS open, close_hour * 60 + close_minute AS close, \
+                        1440 * CASE day WHEN 'Monday' THEN 0 WHEN 'Tuesday' THEN 1 WHEN 'Wednesday' THEN 2              \
+                        WHEN 'Thursday' THEN 3 WHEN 'Friday' THEN 4 WHEN 'Saturday' THEN 5 ELSE 6 END AS day_start       \
+                        FROM time                                                                                       \
+                        WHERE open_hour IS NOT NULL AND open_hour * 60 + open_minute + close_hour * 60 + close_minute > 0 \
+                        AND place_id IN (SELECT place_id FROM places WHERE open_minute IS NULL)                         \
+                    )"
+    cursor.execute(sql_command)
+
+    # Unknown hours are 9AM to 5PM, no interval at all is closed every day
+    sql_command = f"UPDATE places SET                                                                                   \
+                    open_minute = CASE                                                                                  \
+                        WHEN NOT EXISTS (SELECT 1 FROM time t WHERE t.place_id = places.place_id AND t.open_hour IS NOT NULL) \
+                          OR EXISTS (SELECT 1 FROM time t WHERE t.place_id = places.place_id AND t.open_hour IS NULL) THEN 540 \
+                        ELSE COALESCE((SELECT MIN(start_minute % 1440) FROM opening_intervals o WHERE o.place_id = places.place_id), 1440) \
+                    END,                                                                                                \
+                    close_minute = CASE                                                                                 \
+                        WHEN NOT EXISTS (SELECT 1 FROM time t WHERE t.place_id = places.place_id AND t.open_hour IS NOT NULL) \
+                          OR EXISTS (SELECT 1 FROM time t WHERE t.place_id = places.place_id AND t.open_hour IS NULL) THEN 1020 \
+                        ELSE COALESCE((SELECT MAX(MIN(end_minute - start_minute / 1440 * 1440, 1440)) FROM opening_intervals o WHERE o.place_id = places.place_id), 1440) \
+                    END                                                                                                 \
+                    WHERE open_minute IS NULL"
+    cursor.execute(sql_command)
+
+def create_places_rtree(cursor):
+    '''
+    Creates an R*Tree index on the coordinates of the places, kept in sync with triggers
+    Rows are keyed by places.id, each place is a point (min = max)
+    '''
+
+    cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS places_rtree USING rtree (id, min_lat, max_lat, min_lng, max_lng)")
+
+    cursor.execute("CREATE TRIGGER IF NOT EXISTS places_rtree_insert AFTER INSERT ON places WHEN new.lat IS NOT NULL AND new.lng IS NOT NULL BEGIN \
+                    INSERT OR REPLACE INTO places_rtree VALUES (new.id, new.lat, new.lat, new.lng, new.lng); END")
+    cursor.execute("CREATE TRIGGER IF NOT EXISTS places_rtree_update AFTER UPDATE OF lat, lng ON places BEGIN  \
+                    DELETE FROM places_rtree WHERE id = old.id;                                                \
+                    INSERT INTO places_rtree SELECT new.id, new.lat, new.lat, new.lng, new.lng                 \
+                    WHERE new.lat IS NOT NULL AND new.lng IS NOT NULL; END")
+    cursor.execute("CREATE TRIGGER IF NOT EXISTS places_rtree_delete AFTER DELETE ON places BEGIN              \
+                    DELETE FROM places_rtree WHERE id = old.id; END")
+
+    # Index the places inserted before the triggers existed
+    cursor.execute("INSERT OR REPLACE INTO places_rtree SELECT id, lat, lat, lng, lng FROM places WHERE lat IS NOT NULL AND lng IS NOT NULL")
+
+def create_indexes(cursor):
+    '''
+    Creates the indexes used by the request path: places of a city, times and photos of a place and city lookups
+    '''
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS places_city_id ON places (city_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS time_place_id ON time (place_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS photos_place_id ON photos (place_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS cities_name_country ON cities (name, country)")
+
+def create_place_fields_table(cursor):
+    '''
+    Creating a table to store when each field of the details of a place was last fetched from Google
+    Places without rows (scraped before it existed) are fetched again the first time they are required
+    '''
+
+    sql_command = f"CREATE TABLE IF NOT EXISTS place_fields (          \
+                    place_id TEXT,                                  \
+                    field TEXT,                                     \
+                    fetched_at INTEGER,                             \
+                    PRIMARY KEY (place_id, field),                  \
+                    FOREIGN KEY (place_id) REFERENCES places(id)    \
+                    ) WITHOUT ROWID"
     cursor.execute(sql_command)
-    conn.commit()
-    conn.close()
 
+def delete_haversine_travel_times(cursor):
+    '''
+    Deleting the Haversine estimates saved in the travel_times cache, only Google travel times are cached now
+    '''
+
+    # travel_times is created by data_scraper.py the first time it is used
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'travel_times'")
+    if cursor.fetchone():
+        cursor.execute("DELETE FROM travel_times WHERE source = 'haversine'")
+
+def round_visit_minutes(cursor):
+    '''
+    Rounding the visit times to whole minutes, the solver only takes integer durations
+    '''
+
+    cursor.execute("UPDATE places SET visit_minutes = ROUND(visit_minutes) WHERE visit_minutes IS NOT NULL")
+
+def add_city_scraped_at_column(cursor):
+    '''
+    Adds when the scraping of a city finished to the cities table, NULL while it never did
+    Cities that already have places were scraped before it existed, the others are scraped again when they are requested
+    '''
+
+    cursor.execute("PRAGMA table_info(cities)")
+    if 'scraped_at' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE cities ADD COLUMN scraped_at INTEGER NULL")
+    cursor.execute("UPDATE cities SET scraped_at = CAST(strftime('%s', 'now') AS INTEGER) WHERE scraped_at IS NULL AND id IN (SELECT city_id FROM places)")
 
-def create_category_table():
+def create_ingest_jobs_table(cursor):
     '''
-    Divides the categories column in the places table into a separate table
-    With each unique category as a one separate column
+    Creating a table to store the background scraping jobs of cities (see ingest_queue.py)
+    so every web worker sees them and they are resumed after a restart
     '''
 
-    conn = sqlite3.connect('travel.db')
+    sql_command = f"CREATE TABLE IF NOT EXISTS ingest_jobs (    \
+                    id TEXT PRIMARY KEY,                        \
+                    city_id INTEGER,                            \
+                    city TEXT,                                  \
+                    country TEXT,                               \
+                    lat REAL,                                   \
+                    lng REAL,                                   \
+                    status TEXT,                                \
+                    created_at REAL,                            \
+                    started_at REAL,                            \
+                    heartbeat_at REAL,                          \
+                    finished_at REAL,                           \
+                    num_places INTEGER,                         \
+                    error TEXT,                                 \
+                    FOREIGN KEY (city_id) REFERENCES cities(id) \
+                    )"
+    cursor.execute(sql_command)
+    cursor.execute("CREATE INDEX IF NOT EXISTS ingest_jobs_city ON ingest_jobs (city, country, status)")
+
+# Schema versions in order, never renumber or remove one: add a new version instead
+# Every step is idempotent so databases created before schema_version existed can run them all
+MIGRATIONS = [
+    (1, create_cities_table),
+    (2, create_places_table),
+    (3, create_time_table),
+    (4, create_photos_table),
+    (5, create_place_categories_table),
+    (6, migrate_category_table),
+    (7, add_opening_window_columns),
+    (8, add_visit_minutes_column),
+    (9, create_opening_intervals_table),
+    (10, backfill_opening_windows),
+    (11, create_places_rtree),
+    (12, create_indexes),
+    (13, create_place_fields_table),
+    (14, delete_haversine_travel_times),
+    (15, round_visit_minutes),
+    (16, add_city_scraped_at_column),
+    (17, create_ingest_jobs_table),
+]
+
+def migrate(db_path = 'travel.db'):
+    '''
+    Upgrades the database to the latest schema version, applying each missing migration in its own transaction
+    Returns the version of the database
+    '''
+    conn = sqlite3.connect(db_path, isolation_level = None) # transactions are handled explicitly
     cursor = conn.cursor()
+    cursor.execute("PRAGMA busy_timeout = 5000") # the website may be using the database
 
-    # Create categories table with every field in categories as a column
-    create_table_query = "CREATE TABLE IF NOT EXISTS categories (place_id TEXT PRIMARY KEY, FOREIGN KEY (place_id) REFERENCES places(id))"
-    cursor.execute(create_table_query)
+    cursor.execute("CREATE TABLE IF NOT EXISTS schema_version (     \
+                    version INTEGER PRIMARY KEY,                    \
+                    name TEXT,                                      \
+                    applied_at TEXT DEFAULT CURRENT_TIMESTAMP       \
+                    )")
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    version = cursor.fetchone()[0]
 
-    conn.commit()
-    conn.close()
+    for migration_version, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process (e.g. a web worker starting at the same time) may have applied it since
+            cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            if cursor.fetchone()[0] >= migration_version:
+                cursor.execute("COMMIT")
+                version = migration_version
+                continue
+
+            migration(cursor)
+            cursor.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (migration_version, migration.__name__))
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
 
+        version = migration_version
+        print(f"Applied migration {migration_version}: {migration.__name__}")
+
+    conn.close()
+    return version
 
 
 if __name__ == '__main__':
-    create_cities_table()
-    create_places_table()
-    create_time_table()
-    create_photos_table()
-    create_category_table()
\ No newline at end of file
+    # Usage: python create-databases.py [path to the database, travel.db by default]
+    db_path = sys.argv[1] if len(sys.argv) > 1 else 'travel.db'
+    print(f"{db_path} is at schema version {migrate(db_path)}")
@@ -1,8 +1,15 @@
-from flask import Flask, render_template, request, url_for, redirect
+from flask import Flask, render_template, request, url_for, redirect, jsonify, Response, session
 import os
 from dotenv import load_dotenv
 from data_scraper import *
 from routing_basic import *
+from plan_cache import PlanCache
+from solver_pool import SolverExecutor, SolverTimeout
+from concurrent.futures.process import BrokenProcessPool
+from evaluation import run_sweep, report_to_csv
+from catalog import load_catalog, load_catalog_snapshot
+from ingest_queue import IngestQueue
+from db import migrate_database
 
 
 app = Flask(__name__,
@@ -38,6 +45,56 @@ valid_categories = set(categories.values())
 
 GOOGLE_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
 
+plan_cache = None
+ingest_queue = None
+solver = None
+solve = None
+
+def init_services():
+    '''
+    Creates the plan cache, place catalog, ingest queue and solver pool used by the routes
+    '''
+    global plan_cache, ingest_queue, solver, solve
+
+    # A checkout or a pull may come with a travel.db that is older than the code
+    migrate_database()
+
+    # Resubmitting the same form reuses the plan instead of solving again
+    plan_cache = PlanCache(
+        max_size=app.config.get('PLAN_CACHE_SIZE', 128),
+        ttl=app.config.get('PLAN_CACHE_TTL', 3600),
+        db_path=app.config.get('PLAN_CACHE_DB'),
+    )
+
+    # Candidate places are filtered in memory instead of querying the database on every request
+    # or mapped from a snapshot exported with catalog.py, shared by all the web workers
+    if app.config.get('PLACE_CATALOG_SNAPSHOT'):
+        load_catalog_snapshot(time_spent_per_type, app.config['PLACE_CATALOG_SNAPSHOT'])
+    elif app.config.get('PLACE_CATALOG', True):
+        load_catalog(time_spent_per_type)
+
+    # New cities are scraped in the background while requests plan with the places already known
+    if app.config.get('INGEST_BACKGROUND', True):
+        ingest_queue = IngestQueue(update_city, workers=app.config.get('INGEST_WORKERS', 1))
+        ingest_queue.resume()
+
+    # Solving happens in worker processes so web workers stay responsive
+    solver = SolverExecutor(
+        max_workers=app.config.get('SOLVER_WORKERS'),
+        timeout=app.config.get('SOLVER_TIMEOUT', 60),
+    )
+    if app.config.get('SOLVER_CLUSTERED'):
+        solve = solver.solve_clustered
+    elif app.config.get('SOLVER_PORTFOLIO'):
+        solve = solver.solve_portfolio
+    else:
+        solve = solver.solve
+
+# The spawned solver workers import this module again (as __mp_main__ when it is run directly),
+# they only need router() so they skip the services of the web process
+if __name__ != '__mp_main__':
+    init_services()
+
 def preprocess_data(data):
      # Reformating
     data['must_locations'] = [tuple(info.split("$")) for info in data['must_locations'].split('*')]
@@ -75,10 +132,16 @@ def results():
     data = preprocess_data(dict(request.form))
 
     # Getting the required and optional locations based on data
-    required, optional = get_attractions_user_input(data)
+    jobs = []
+    required, optional = get_attractions_user_input(data, ingest_queue, jobs)
 
-    # Call to optimized routing
-    optimized_route_output, travel_time, visit_time, num_sites = router(required, optional, data['ranking_considered'] == "yes", data['transport'], int(data['numDays']))
+    # Call to optimized routing, starting from the last plan of this user when it changed
+    try:
+        session['plan_key'], (optimized_route_output, travel_time, visit_time, num_sites) = plan_cache.get_or_compute(
+            solve, required, optional, data['ranking_considered'] == "yes", data['transport'], int(data['numDays']), previous_key=session.get('plan_key'))
+    except (SolverTimeout, BrokenProcessPool) as error:
+        print(error)
+        optimized_route_output, travel_time, visit_time, num_sites = [], 0, 0, 0
 
     return render_template("results.html", 
                         routes=optimized_route_output,
@@ -89,6 +152,7 @@ def results():
                         optional=optional,
                         google_key=GOOGLE_KEY,
                         transport=data['transport'],
+                        jobs=jobs,
                         )
 
 @app.route('/eval', methods = ["POST"])
@@ -98,12 +162,26 @@ def evaluation():
     required, optional = get_attractions_user_input(data)
     print(f"Num required: {len(required)}, Num optional: {len(optional)}")
 
-    for day in [1, 3, 5, 7, 10]:
-        for transport in ["public transport", "car", "walking", "bike"]:
-            optimized_route_output, travel_time, visit_time, num_sites = router(required, optional, False, transport, day)
-            print(f"{day} Days ({transport}):\n {optimized_route_output =}\n {travel_time =}\n {visit_time =}\n {num_sites =}\n")
+    # Every (days, transport) configuration solved in parallel, add ?format=csv for CSV
+    report = run_sweep(solver, required, optional)
+
+    if request.args.get('format') == 'csv':
+        return Response(report_to_csv(report), mimetype='text/csv')
+    return jsonify(report)
+
+
+@app.route('/jobs/<string:job_id>', methods = ["GET"])
+def job_status(job_id):
+    job = ingest_queue.get(job_id) if ingest_queue else None
+    if job is None:
+        return jsonify({'error': "This job doesn't exist"}), 404
+    return jsonify(job)
+
 
-    return redirect(url_for("data", _method="GET"))          
+@app.route('/stats', methods = ["GET"])
+def stats():
+    # Hit/miss counters of the plan cache of this process
+    return jsonify({'plan_cache': plan_cache.stats()})
 
 
 @app.route('/scrape/<string:city_name>', methods = ["GET"])
@@ -0,0 +1,80 @@
+"""
+Benchmarks city ingestion and candidate assembly against the offline Maps stand-in
+
+Scrapes synthetic cities into a fresh database with simulated API latency and errors, then
+resolves the same user request repeatedly (as /results does before solving). Reports the
+ingestion throughput, the request latency percentiles and the stand-in's per-method statistics.
+Runs are deterministic for a given seed.
+
+Usage: python benchmark_ingestion.py [num_cities] [latency_ms] [error_rate] [requests_per_second] [num_requests]
+"""
+
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from db import migrate_database
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+os.environ['MAPS_CLIENT'] = 'synthetic' # before data_scraper creates its client
+
+def create_database(directory):
+    '''
+    Creates an empty travel.db in directory/Databases with create-databases.py
+    '''
+    os.makedirs(os.path.join(directory, 'Databases'))
+    migrate_database(os.path.join(directory, 'Databases', 'travel.db'))
+
+def user_request(lat, lng):
+    '''
+    Returns the form data of a 3 day trip to one landmark (as preprocessed by app.py)
+    '''
+    return {'must_locations': [(str(lat), str(lng))], 'must_names': ['Landmark'], 'hotel_name': 'Hotel',
+            'hotel_loc': (str(lat + 0.01), str(lng + 0.01)), 'sleepTime': '23:00', 'wakeTime': '08:00',
+            'budget': '3', 'include': [], 'exclude': ['night_club']}
+
+if __name__ == '__main__':
+    num_cities = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.1
+    error_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    rate = float(sys.argv[4]) if len(sys.argv) > 4 else None
+    num_requests = int(sys.argv[5]) if len(sys.argv) > 5 else 20
+
+    directory = tempfile.mkdtemp(prefix='benchmark-ingestion-')
+    create_database(directory)
+    os.chdir(directory) # data_scraper uses Databases/travel.db
+    sys.path.insert(0, ROOT)
+
+    import data_scraper
+    from maps_client import SyntheticClient
+    from rate_limit import TokenBucket
+
+    client = SyntheticClient(latency=latency, jitter=0.5, error_rate=error_rate, seed=0)
+    data_scraper.gmaps = client
+    if rate:
+        data_scraper.places_bucket = TokenBucket(rate)
+
+    # Ingestion: every city is scraped by update_city like a new city in a user request
+    total_places = 0
+    start = time.perf_counter()
+    for city in range(num_cities):
+        city_start = time.perf_counter()
+        lat, lng = 40.0 + city, -70.0
+        place_ids = data_scraper.update_city(lat, lng, *data_scraper.get_city_country(lat, lng))
+        total_places += len(place_ids)
+        print(f"City {city}: {len(place_ids)} places in {time.perf_counter() - city_start:.2f}s")
+    ingestion_seconds = time.perf_counter() - start
+
+    # Request path: the first request resolves the landmark, the next ones hit the caches
+    latencies = []
+    for _ in range(num_requests):
+        request_start = time.perf_counter()
+        required, optional = data_scraper.get_attractions_user_input(user_request(40.0, -70.0))
+        latencies.append(time.perf_counter() - request_start)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+
+    print(f"\nIngested {total_places} places in {ingestion_seconds:.2f}s ({total_places / ingestion_seconds:.1f} places/s)")
+    print(f"Candidate assembly: {len(required)} required and {len(optional)} optional places, "
+          f"first request {latencies[0] * 1000:.1f}ms, p50 {p50:.1f}ms, p95 {p95:.1f}ms, p99 {p99:.1f}ms")
+    print(f"Stand-in: {client.stats()}")
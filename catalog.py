@@ -0,0 +1,418 @@
+"""
+In-memory catalog of the places in the travel database
+
+The places are loaded once into columns (numpy arrays) and their categories into an index of
+(category code, row) entries, so the category and budget filters of get_routes_simple run without
+querying SQLite. Ingestion refreshes the places it writes through refresh_catalog, which only
+writes their rows.
+
+The catalog can also be exported to a snapshot file (python catalog.py [snapshot] [database])
+that processes memory-map instead of reading the database, so they share its pages. A snapshot
+is never modified: a new one replaces the file atomically and processes switch to it when its
+version changes.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from db import get_connection, DB_PATH
+
+PLACE_COLUMNS = "place_id, name, lat, lng, price_level, rating, open_minute, close_minute, CAST(visit_minutes AS INTEGER)"
+
+# Arrays of a catalog with one value per place
+COLUMN_TYPES = {
+    'lat': np.float64,
+    'lng': np.float64,
+    'price_level': np.float32,      # NaN when unknown
+    'rating': np.float32,           # NaN when unknown
+    'open_minute': np.int16,        # -1 when unknown
+    'close_minute': np.int16,
+    'visit_minutes': np.int16,      # whole minutes
+    'entry_start': np.int64,        # first category entry of the place
+    'entry_count': np.int32,        # number of categories of the place
+}
+SNAPSHOT_COLUMNS = ['lat', 'lng', 'price_level', 'rating', 'open_minute', 'close_minute', 'visit_minutes']
+MIN_CAPACITY = 1024 # rows and category entries allocated at least
+
+READ_CHUNK = 500 # place ids per query when reading some of the places
+
+SNAPSHOT_PATH = 'Databases/catalog.snapshot'
+SNAPSHOT_MAGIC = b'PLCATv1\n'
+SNAPSHOT_ALIGN = 64 # arrays start on cache line boundaries
+
+_catalog = None
+_snapshot = None # path, file identity and category minutes of the mapped snapshot
+
+class StringColumn:
+    '''
+    Read-only list of strings stored as one UTF-8 buffer and the offsets of the strings in it
+    '''
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def encode(cls, strings):
+        encoded = [(string or '').encode() for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(string) for string in encoded])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode()
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+class PlaceCatalog:
+    '''
+    Columns of the places in the order they were loaded (places.id order for a full load), with the visit time
+    of the places scraped before visit_minutes existed averaged from category_minutes (60 by default)
+
+    The columns have spare capacity (len(self) rows are used) so places are appended in amortized O(1),
+    and updating a place overwrites its row. The categories are entries (category code, row): the entries
+    of a place are entry_count[row] consecutive entries from entry_start[row]. An update appends new
+    entries and blanks the old ones (code -1), which are compacted away once they are the majority.
+    '''
+
+    def __init__(self, category_minutes, db_path = DB_PATH):
+        self.category_minutes = category_minutes
+        self.db_path = db_path
+        self.lock = threading.Lock()
+
+        self.place_ids = []
+        self.names = []
+        self.index = {}                                     # place_id -> row
+        for name, dtype in COLUMN_TYPES.items():
+            setattr(self, name, np.empty(0, dtype=dtype))
+
+        self.category_codes = {}                            # category -> code
+        self.indices = np.empty(0, dtype=np.int32)          # category code of each entry, -1 when replaced
+        self.entry_rows = np.empty(0, dtype=np.int32)       # row of each entry
+        self.num_entries = 0
+        self.num_replaced = 0
+        self.writable = True                                # False while the arrays are views of a snapshot
+
+    def __len__(self):
+        return len(self.place_ids)
+
+    def _reserve(self, num_rows, num_entries):
+        # Grows the arrays that are too small to at least twice their size,
+        # the read-only arrays of a snapshot are copied on the first update
+        if not self.writable:
+            self.names = list(self.names)
+
+        for name, dtype in list(COLUMN_TYPES.items()) + [('indices', np.int32), ('entry_rows', np.int32)]:
+            array = getattr(self, name)
+            needed, used = (num_entries, self.num_entries) if name in ('indices', 'entry_rows') else (num_rows, len(self))
+            if len(array) < needed or not self.writable:
+                grown = np.empty(max(needed, len(array) if len(array) >= needed else 2 * len(array), MIN_CAPACITY), dtype=dtype)
+                grown[:used] = array[:used]
+                setattr(self, name, grown)
+
+        self.writable = True
+
+    def csr(self):
+        '''
+        Returns the categories of the places as a compact CSR index (indptr, indices, entry_rows):
+        the category codes of row i are indices[indptr[i]:indptr[i + 1]]
+        '''
+        live = self.indices[:self.num_entries] >= 0
+        order = np.argsort(self.entry_rows[:self.num_entries][live], kind='stable')
+        indices = self.indices[:self.num_entries][live][order]
+        entry_rows = self.entry_rows[:self.num_entries][live][order]
+        indptr = np.concatenate([[0], np.cumsum(self.entry_count[:len(self)])]).astype(np.int32)
+        return indptr, indices.astype(np.int32), entry_rows.astype(np.int32)
+
+    def _compact(self):
+        indptr, indices, entry_rows = self.csr()
+        self.indices[:len(indices)] = indices
+        self.entry_rows[:len(entry_rows)] = entry_rows
+        self.entry_start[:len(self)] = indptr[:-1]
+        self.num_entries = len(indices)
+        self.num_replaced = 0
+
+    def upsert(self, rows, place_categories):
+        '''
+        Adds or replaces places given as (PLACE_COLUMNS) rows and their (place_id, category) pairs
+        '''
+        categories = {}
+        for place_id, category in place_categories:
+            categories.setdefault(place_id, []).append(category)
+
+        rows = list({row[0]: row for row in rows}.values()) # the last row of a place wins
+        if not rows:
+            return
+
+        with self.lock:
+            num_new = len(set([row[0] for row in rows if row[0] not in self.index]))
+            num_codes = sum([len(categories.get(row[0], [])) for row in rows])
+            self._reserve(len(self) + num_new, self.num_entries + num_codes)
+
+            targets = np.empty(len(rows), dtype=np.int64)
+            counts = np.empty(len(rows), dtype=np.int64)
+            codes = []
+            visit = []
+            for i, (place_id, name, _, _, _, _, _, _, visit_minutes) in enumerate(rows):
+                row = self.index.get(place_id)
+                if row is None:
+                    row = len(self.place_ids)
+                    self.index[place_id] = row
+                    self.place_ids.append(place_id)
+                    self.names.append(name)
+                else:
+                    self.names[row] = name
+                    start, count = self.entry_start[row], self.entry_count[row]
+                    self.indices[start:start + count] = -1
+                    self.num_replaced += int(count)
+
+                place_categories = categories.get(place_id, [])
+                codes += [self.category_codes.setdefault(category, len(self.category_codes)) for category in place_categories]
+                if visit_minutes is None:
+                    times = [self.category_minutes[category] for category in place_categories if category in self.category_minutes]
+                    visit_minutes = int(sum(times) / len(times) + 0.5) if times else 60
+                targets[i] = row
+                counts[i] = len(place_categories)
+                visit.append(visit_minutes)
+
+            columns = list(zip(*rows))
+            self.lat[targets] = np.array(columns[2], dtype=np.float64)
+            self.lng[targets] = np.array(columns[3], dtype=np.float64)
+            self.price_level[targets] = np.array([np.nan if value is None else value for value in columns[4]], dtype=np.float32)
+            self.rating[targets] = np.array([np.nan if value is None else value for value in columns[5]], dtype=np.float32)
+            self.open_minute[targets] = np.array([-1 if value is None else value for value in columns[6]], dtype=np.int16)
+            self.close_minute[targets] = np.array([-1 if value is None else value for value in columns[7]], dtype=np.int16)
+            self.visit_minutes[targets] = np.array(visit, dtype=np.int16)
+
+            # The new categories are appended after the current entries
+            start = self.num_entries
+            self.indices[start:start + len(codes)] = codes
+            self.entry_rows[start:start + len(codes)] = np.repeat(targets, counts)
+            self.entry_start[targets] = start + np.cumsum(counts) - counts
+            self.entry_count[targets] = counts
+            self.num_entries += len(codes)
+
+            if self.num_replaced > self.num_entries // 2:
+                self._compact()
+
+    def category_counts(self, categories):
+        '''
+        Returns how many of the categories each place has, and how many of the categories are known
+        '''
+        codes = [self.category_codes[category] for category in set(categories) if category in self.category_codes]
+        entries = np.isin(self.indices[:self.num_entries], codes)
+        counts = np.bincount(self.entry_rows[:self.num_entries][entries], minlength=len(self))
+        return counts, len(codes)
+
+    def select(self, place_ids, filters_including, filters_excluding, budget_level):
+        '''
+        Returns the (place_id, name, lat, lng, open_minute, close_minute, visit_minutes) of the places
+        with these ids that pass the filters, same rules and order as the query of get_routes_simple
+
+        Places that aren't in the catalog yet (e.g. written by another process) are loaded from the database first
+        '''
+        with self.lock:
+            missing = [place_id for place_id in set(place_ids) if place_id not in self.index]
+        if missing:
+            self.upsert(*read_places(self.db_path, missing))
+
+        with self.lock:
+            rows = np.array(sorted(set([self.index[place_id] for place_id in place_ids if place_id in self.index])), dtype=np.int64)
+
+            # Places with all of the excluded categories that exist in the database (none if no category exists)
+            keep = np.isnan(self.price_level[rows]) | (self.price_level[rows] < budget_level)
+            if filters_excluding:
+                counts, known = self.category_counts(filters_excluding)
+                if known:
+                    keep &= counts[rows] != known
+
+            # Places with at least one of the included categories
+            if filters_including:
+                counts, _ = self.category_counts(filters_including)
+                keep &= counts[rows] > 0
+
+            return [(self.place_ids[row], self.names[row], float(self.lat[row]), float(self.lng[row]),
+                     None if self.open_minute[row] < 0 else int(self.open_minute[row]),
+                     None if self.close_minute[row] < 0 else int(self.close_minute[row]),
+                     int(self.visit_minutes[row])) for row in rows[keep]]
+
+def export_snapshot(catalog, path = SNAPSHOT_PATH):
+    '''
+    Writes the catalog to a snapshot file and returns its version (a hash of its content)
+    The file is written next to the destination and renamed over it, so readers see the old or the new snapshot
+    '''
+    with catalog.lock:
+        place_ids = StringColumn.encode(catalog.place_ids)
+        names = StringColumn.encode(catalog.names)
+        categories = StringColumn.encode(sorted(catalog.category_codes, key=catalog.category_codes.get))
+        indptr, indices, entry_rows = catalog.csr()
+        arrays = {name: getattr(catalog, name)[:len(catalog)] for name in SNAPSHOT_COLUMNS}
+        arrays.update({
+            'indptr': indptr, 'indices': indices, 'entry_rows': entry_rows,
+            'place_ids': place_ids.data, 'place_id_offsets': place_ids.offsets,
+            'names': names.data, 'name_offsets': names.offsets,
+            'categories': categories.data, 'category_offsets': categories.offsets,
+        })
+        arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+
+    content = hashlib.sha256()
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        content.update(name.encode() + array.tobytes())
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+
+    version = content.hexdigest()[:16]
+    header = json.dumps({'version': version, 'created_at': time.time(), 'num_places': len(catalog), 'arrays': layout}).encode()
+    data_start = -(-(len(SNAPSHOT_MAGIC) + 8 + len(header)) // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.catalog-', delete=False) as file:
+        file.write(SNAPSHOT_MAGIC + len(header).to_bytes(8, 'little') + header)
+        for name, array in arrays.items():
+            file.seek(data_start + layout[name]['offset'])
+            file.write(array.tobytes())
+        file.truncate(data_start + offset)
+        file.flush()
+        os.fsync(file.fileno())
+    os.chmod(file.name, 0o644) # temporary files are only readable by their owner
+    os.replace(file.name, path)
+
+    return version
+
+def read_snapshot(path, category_minutes, db_path = DB_PATH):
+    '''
+    Returns the catalog of a snapshot file, its columns are read-only views of the memory-mapped file
+    '''
+    mapped = np.memmap(path, dtype=np.uint8, mode='r')
+    if bytes(mapped[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+        raise ValueError(f"{path} is not a catalog snapshot")
+
+    header_start = len(SNAPSHOT_MAGIC) + 8
+    header_length = int.from_bytes(bytes(mapped[len(SNAPSHOT_MAGIC):header_start]), 'little')
+    header = json.loads(bytes(mapped[header_start:header_start + header_length]))
+    data_start = -(-(header_start + header_length) // SNAPSHOT_ALIGN) * SNAPSHOT_ALIGN
+
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        dtype = np.dtype(layout['dtype'])
+        start = data_start + layout['offset']
+        count = int(np.prod(layout['shape']))
+        arrays[name] = mapped[start:start + count * dtype.itemsize].view(dtype).reshape(layout['shape'])
+
+    catalog = PlaceCatalog(category_minutes, db_path)
+    for name in SNAPSHOT_COLUMNS + ['indices', 'entry_rows']:
+        setattr(catalog, name, arrays[name])
+    catalog.entry_start = arrays['indptr'][:-1]
+    catalog.entry_count = np.diff(arrays['indptr'])
+    catalog.num_entries = len(arrays['indices'])
+    catalog.writable = False
+    catalog.place_ids = list(StringColumn(arrays['place_ids'], arrays['place_id_offsets']))
+    catalog.index = {place_id: row for row, place_id in enumerate(catalog.place_ids)}
+    catalog.names = StringColumn(arrays['names'], arrays['name_offsets']) # decoded when read
+    catalog.category_codes = {category: code for code, category in enumerate(StringColumn(arrays['categories'], arrays['category_offsets']))}
+
+    catalog.snapshot_version = header['version']
+    return catalog
+
+def read_places(db_path = DB_PATH, place_ids = None):
+    '''
+    Returns the rows and (place_id, category) pairs of the places with these ids (all of them by default)
+    '''
+    conn = get_connection(db_path)
+    cursor = conn.cursor()
+
+    if place_ids is None:
+        cursor.execute(f"SELECT {PLACE_COLUMNS} FROM places ORDER BY id")
+        rows = cursor.fetchall()
+        cursor.execute("SELECT place_id, category FROM place_categories")
+        return rows, cursor.fetchall()
+
+    # In chunks so the number of ids stays under the limit of SQL variables
+    place_ids = list(place_ids)
+    rows, place_categories = [], []
+    for start in range(0, len(place_ids), READ_CHUNK):
+        chunk = place_ids[start:start + READ_CHUNK]
+        marks = ', '.join(['?'] * len(chunk))
+        cursor.execute(f"SELECT id, {PLACE_COLUMNS} FROM places WHERE place_id IN ({marks})", chunk)
+        rows += cursor.fetchall()
+        cursor.execute(f"SELECT place_id, category FROM place_categories WHERE place_id IN ({marks})", chunk)
+        place_categories += cursor.fetchall()
+
+    return [row[1:] for row in sorted(rows)], place_categories
+
+def load_catalog(category_minutes, db_path = DB_PATH):
+    '''
+    Loads every place of the database in the catalog used by get_routes_simple and returns it
+    '''
+    global _catalog, _snapshot
+
+    catalog = PlaceCatalog(category_minutes, db_path)
+    catalog.upsert(*read_places(db_path))
+    _catalog = catalog
+    _snapshot = None
+
+    print(f"Loaded {len(catalog)} places and {len(catalog.category_codes)} categories in the catalog")
+    return catalog
+
+def load_catalog_snapshot(category_minutes, path = SNAPSHOT_PATH, db_path = DB_PATH):
+    '''
+    Maps a snapshot file as the catalog used by get_routes_simple and returns it
+    get_catalog switches to a new snapshot when one replaces the file
+    '''
+    global _catalog, _snapshot
+
+    stat = os.stat(path)
+    catalog = read_snapshot(path, category_minutes, db_path)
+    _snapshot = {'path': path, 'file': (stat.st_ino, stat.st_mtime_ns), 'category_minutes': category_minutes}
+    _catalog = catalog
+
+    print(f"Mapped {len(catalog)} places from the catalog snapshot {path} (version {catalog.snapshot_version})")
+    return catalog
+
+def get_catalog():
+    '''
+    Returns the loaded catalog, None if load_catalog wasn't called
+    '''
+    global _catalog
+
+    # A new snapshot is a new file: compare the inode and modification time before reading it
+    if _snapshot is not None:
+        try:
+            stat = os.stat(_snapshot['path'])
+            if (stat.st_ino, stat.st_mtime_ns) != _snapshot['file']:
+                _snapshot['file'] = (stat.st_ino, stat.st_mtime_ns)
+                catalog = read_snapshot(_snapshot['path'], _snapshot['category_minutes'], _catalog.db_path)
+                if catalog.snapshot_version != getattr(_catalog, 'snapshot_version', None):
+                    print(f"Switched to the catalog snapshot version {catalog.snapshot_version}")
+                    _catalog = catalog
+        except (OSError, ValueError) as e:
+            print(f"Keeping the current catalog, the snapshot can't be read: {e}")
+
+    return _catalog
+
+def refresh_catalog(place_ids):
+    '''
+    Reloads these places from the database if the catalog is loaded
+    '''
+    if _catalog is not None and place_ids:
+        _catalog.upsert(*read_places(_catalog.db_path, place_ids))
+
+if __name__ == '__main__':
+    # Usage: python catalog.py [snapshot path] [database path]
+    path = sys.argv[1] if len(sys.argv) > 1 else SNAPSHOT_PATH
+    db_path = sys.argv[2] if len(sys.argv) > 2 else DB_PATH
+
+    from data_scraper import time_spent_per_type
+    catalog = load_catalog(time_spent_per_type, db_path)
+    print(f"Wrote {path} version {export_snapshot(catalog, path)}")
@@ -1,16 +1,42 @@
 import googlemaps
+import googlemaps.exceptions
+import json
 import os
 from dotenv import load_dotenv
 import re
 
+import math
+import threading
 import time
-import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from db import get_connection
+from catalog import get_catalog, refresh_catalog
+from rate_limit import TokenBucket, call_with_retries
+from maps_client import make_client
+from distances import haversine_pairs, EARTH_R_METERS
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize Google Maps API client
-gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
+# Initialize Google Maps API client (or an offline stand-in, see maps_client.py)
+gmaps = make_client()
+
+# Whether the solver uses travel times from the Distance Matrix API (fetched once per pair, see fetch_travel_times)
+# instead of Haversine estimates, billed by Google for every new pair
+GOOGLE_TRAVEL_TIMES = os.getenv('GOOGLE_TRAVEL_TIMES') == '1'
+
+# Places API requests of all the scraping threads share this rate limit
+PLACES_RATE = 10 # requests per second
+places_bucket = TokenBucket(PLACES_RATE)
+DETAILS_WORKERS = 8 # place details fetched in parallel
+
+# Reverse geocoding results are cached by coordinates rounded to GEOCODE_DECIMALS (about 1 meter)
+GEOCODE_DECIMALS = 5
+GEOCODE_TTL = 30 * 24 * 3600 # seconds
+GEOCODE_MEMORY_SIZE = 1024 # results also kept in memory
+geocode_memory = OrderedDict() # key -> (fetched_at, result)
+geocode_lock = threading.Lock()
 
 # Define fields to extract from the Google Places API
 fields = [
@@ -28,9 +54,51 @@ fields = [
             'place_id'                                      # Unique identifier for the place
         ]
 
+# How long (in seconds) each field of the details of a place stays fresh, None if it never changes
+DAY = 24 * 3600
+FIELD_TTL = {
+    'name': None,
+    'formatted_address': 365 * DAY,
+    'rating': 30 * DAY,
+    'opening_hours': 7 * DAY,
+    'photo': 180 * DAY,
+    'geometry': None,
+    'type': 180 * DAY,
+    'price_level': 90 * DAY,
+    'user_ratings_total': 30 * DAY,
+    'url': None,
+    'vicinity': 365 * DAY,
+    'place_id': None,
+}
+
+# Columns of the places table filled by each field of the details (clean_data names)
+FIELD_COLUMNS = {
+    'name': ['name'],
+    'formatted_address': ['address'],
+    'rating': ['rating'],
+    'geometry': ['lat', 'lng'],
+    'type': ['types'],
+    'price_level': ['price_level'],
+    'user_ratings_total': ['user_ratings_total'],
+    'url': ['url'],
+    'vicinity': ['vicinity'],
+}
+
 time_spent_per_category = {'Park': 120, 'Casino': 240, 'Museum': 180, 'Night Club': 180, 'Library': 60, 'Place of Worship': 45.0, 'Book Store': 30.0, 'Cemetery': 90.0, 
 'Stadium': 180, 'Zoo': 180, 'Aquarium': 150.0, 'Art Gallery': 120, 'Restaurant': 90.0, 'Bar': 90.0, 'Bakery': 30.0, 'Clothing Store': 30.0, 'Spa': 180, 'Amusement Park': 420}
 
+# Same times keyed by the Google place types of the categories (e.g. 'night_club')
+time_spent_per_type = {category.lower().replace(' ', '_'): minutes for category, minutes in time_spent_per_category.items()}
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Daily window of places whose opening hours are unknown (9AM to 5PM)
+DEFAULT_WINDOW = (540, 1020)
+
+# Known places within this distance of the hotel or of a required place are candidates
+# (same radius as the nearby search of update_city)
+CANDIDATE_RADIUS_KM = 20
+
 def to_24_hour(time_unicode):
     '''
     Converts a time string from 12-hour format to 24-hour format
@@ -96,7 +164,7 @@ def city_exists(city, country):
     '''
     Checks if a city exists in the database
     '''
-    conn = sqlite3.connect('Databases/travel.db')
+    conn = get_connection()
     cursor = conn.cursor()
     if country and city:
         cursor.execute("SELECT * FROM cities WHERE name = ? AND country = ?", (city, country))
@@ -104,9 +172,19 @@ def city_exists(city, country):
         cursor.execute("SELECT * FROM cities WHERE name = ?", (city, ))
 
     result = cursor.fetchone()
-    conn.close()
     return result
 
+def city_scraped(city_id):
+    '''
+    Checks if the scraping of a city finished (a city is inserted before its places are scraped)
+    '''
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT scraped_at FROM cities WHERE id = ?", (city_id,))
+
+    result = cursor.fetchone()
+    return result is not None and result[0] is not None
+
 def clean_data(place_details):
     '''
     Cleans the place details and returns a formatted dictionary
@@ -142,24 +220,20 @@ def clean_data(place_details):
                 
                 if hours == 'Closed':
                     time_details.append([place_id, {day: (0, 0, 0, 0)}])
-                    #insert_time(place_id, {day: (0, 0, 0, 0)})
                     continue
 
                 if hours == 'Open 24 hours':
                     time_details.append([place_id, {day: (0, 0, 23, 59)}])
-                    #insert_time(place_id, {day: (0, 0, 23, 59)})
                     continue
 
                 # Extract opening and closing times
                 answers = to_24_hour(hours)
                 for answer in answers:
                     time_details.append([place_id, {day: answer}])
-                    #insert_time(place_id, {day: answer})
     else:
         # Insert None values for all days of the week
-        for day in ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']:
+        for day in WEEKDAYS:
             time_details.append([place_id, {day: (None, None, None, None)}])
-            #insert_time(place_id, {day: (None, None, None, None)})
 
     # Geometry
     geometry = place_details.get('geometry', None)
@@ -179,7 +253,6 @@ def clean_data(place_details):
         categories = formatted_details['types'].split(',')
         categories = set([category.strip() for category in categories])
         category_details.append([place_id, categories])
-        #insert_categories(place_id, categories)
     
     # Price Level
     formatted_details['price_level'] = place_details.get('price_level', None)
@@ -204,10 +277,8 @@ def clean_data(place_details):
         height = main_photo.get('height', None)
         width = main_photo.get('width', None)
         photo_details.append([place_id, photo_reference, height, width])
-        #insert_photos(place_id, photo_reference, height, width)
     else:
         photo_details.append([place_id, None, None, None])
-        #insert_photos(place_id, None, None, None)
 
     return [formatted_details, time_details, photo_details, category_details]
     
@@ -215,7 +286,7 @@ def insert_city(city, country):
     '''
     Inserts a city into the database and returns its ID
     '''
-    conn = sqlite3.connect('Databases/travel.db')
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Insert the city and country into the database
@@ -224,341 +295,510 @@ def insert_city(city, country):
     city_id = cursor.lastrowid
     
     conn.commit()
-    conn.close()
 
     return city_id
 
 
-def insert_place(city_id, attractions):
+def insert_places_batch(city_id, cleaned_places):
     '''
-    Inserts tourist attractions into the database
+    Inserts places cleaned by clean_data with their times, opening windows, photos and categories
+    in a single transaction and returns the number of rows written
+    Places that are already in the database are skipped
     '''
-    conn = sqlite3.connect('Databases/travel.db')
+    start = time.perf_counter()
+    conn = get_connection()
     cursor = conn.cursor()
 
-    # Insert each place from attractions
-    for place in attractions:
-        # Convert the place dictionary to a list
-        values = []
-        for val in ['name', 'address', 'rating', 'lat', 'lng', 'types', 'price_level', 'user_ratings_total', 'url', 'vicinity', 'place_id']:
-            values.append(place.get(val))
-        values.append(city_id)
+    place_rows, time_rows, interval_rows, photo_rows, category_rows, field_rows = [], [], [], [], [], []
+    fetched_at = int(time.time())
+    seen = set()
+    for formatted_details, time_details, photo_details, category_details in cleaned_places:
+        place_id = formatted_details['place_id']
+        if place_id in seen:
+            continue
+        seen.add(place_id)
+
+        intervals, (open, close) = opening_window(time_details)
+        categories = set([category for _, types in category_details for category in types])
+        values = [formatted_details.get(val) for val in ['name', 'address', 'rating', 'lat', 'lng', 'types', 'price_level', 'user_ratings_total', 'url', 'vicinity', 'place_id']]
+        place_rows.append(values + [city_id, open, close, visit_minutes(categories) if categories else None])
+
+        time_rows += [(day, hours[0], hours[1], hours[2], hours[3], place_id) for _, opening_hours in time_details for day, hours in opening_hours.items()]
+        interval_rows += [(place_id, start_minute, end_minute) for start_minute, end_minute in intervals]
+        photo_rows += [(photo[1], photo[2], photo[3], photo[0]) for photo in photo_details]
+        category_rows += [(place_id, category) for category in categories]
+        field_rows += [(place_id, field, fetched_at) for field in fields]
+
+    # Commits everything at once, or nothing if a statement fails
+    with conn:
+        # The known places are read once the write lock is held, so another thread or process
+        # can't insert one of them between the check and the inserts
+        cursor.execute("BEGIN IMMEDIATE")
+        place_ids = list(seen)
+        cursor.execute(f"SELECT place_id FROM places WHERE place_id IN ({', '.join(['?'] * len(place_ids))})", place_ids)
+        known = set([place[0] for place in cursor.fetchall()])
+
+        # The known places are skipped with all their rows
+        place_rows = [row for row in place_rows if row[10] not in known]
+        time_rows = [row for row in time_rows if row[5] not in known]
+        interval_rows = [row for row in interval_rows if row[0] not in known]
+        photo_rows = [row for row in photo_rows if row[3] not in known]
+        category_rows = [row for row in category_rows if row[0] not in known]
+        field_rows = [row for row in field_rows if row[0] not in known]
+
+        cursor.executemany("INSERT INTO places (name, address, rating, lat, lng, types, price_level, user_ratings_total, url, vicinity, place_id, city_id, open_minute, close_minute, visit_minutes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", place_rows)
+        cursor.executemany("INSERT INTO time (day, open_hour, open_minute, close_hour, close_minute, place_id) VALUES (?, ?, ?, ?, ?, ?)", time_rows)
+        cursor.executemany("INSERT INTO opening_intervals (place_id, start_minute, end_minute) VALUES (?, ?, ?)", interval_rows)
+        cursor.executemany("INSERT INTO photos (photo_reference, height, width, place_id) VALUES (?, ?, ?, ?)", photo_rows)
+        cursor.executemany("INSERT OR IGNORE INTO place_categories (place_id, category) VALUES (?, ?)", category_rows)
+        cursor.executemany("INSERT OR REPLACE INTO place_fields (place_id, field, fetched_at) VALUES (?, ?, ?)", field_rows)
+
+    refresh_catalog([row[10] for row in place_rows])
+
+    rows = len(place_rows) + len(time_rows) + len(interval_rows) + len(photo_rows) + len(category_rows) + len(field_rows)
+    seconds = time.perf_counter() - start
+    print(f"Inserted {len(place_rows)} places ({rows} rows) in {seconds:.3f}s, {rows / max(seconds, 1e-9):.0f} rows/s")
+
+    return rows
+
+def stale_fields(place_id):
+    '''
+    Returns the fields of the details of a place that were never fetched or are older than their FIELD_TTL
+    '''
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT field, fetched_at FROM place_fields WHERE place_id = ?", (place_id,))
+    fetched_at = dict(cursor.fetchall())
 
-        sql_command = "INSERT INTO places (name, address, rating, lat, lng, types, price_level, user_ratings_total, url, vicinity, place_id, city_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-        cursor.execute(sql_command, values)
-    
-    conn.commit()
-    conn.close()
+    now = time.time()
+    return [field for field in fields if field not in fetched_at or (FIELD_TTL.get(field) is not None and now - fetched_at[field] >= FIELD_TTL[field])]
 
-def insert_time(place_id, opening_hours):
+def update_place_fields(place_id, place_details, updated_fields):
     '''
-    Inserts opening hours into the database
+    Replaces the given fields of a place in the database with the fetched details, in one transaction
     '''
-    conn = sqlite3.connect('Databases/travel.db')
+    formatted_details, time_details, photo_details, category_details = clean_data(place_details)
+    conn = get_connection()
     cursor = conn.cursor()
 
-    # Insert each day's opening hours
-    for day, hours in opening_hours.items():
-        sql_command = "INSERT INTO time (day, open_hour, open_minute, close_hour, close_minute, place_id) VALUES (?, ?, ?, ?, ?, ?)"
-        cursor.execute(sql_command, (day, hours[0], hours[1], hours[2], hours[3], place_id))
-    
-    conn.commit()
-    conn.close()
+    with conn:
+        columns = [column for field in updated_fields for column in FIELD_COLUMNS.get(field, [])]
+        if columns:
+            sql_command = f"UPDATE places SET {', '.join([column + ' = ?' for column in columns])} WHERE place_id = ?"
+            cursor.execute(sql_command, [formatted_details.get(column) for column in columns] + [place_id])
 
-def insert_photos(place_id, photo_reference, height, width):
-    '''
-    Inserts photos into the database
-    '''
-    conn = sqlite3.connect('Databases/travel.db')
-    cursor = conn.cursor()
+        if 'opening_hours' in updated_fields:
+            intervals, (open, close) = opening_window(time_details)
+            cursor.execute("DELETE FROM time WHERE place_id = ?", (place_id,))
+            cursor.executemany("INSERT INTO time (day, open_hour, open_minute, close_hour, close_minute, place_id) VALUES (?, ?, ?, ?, ?, ?)",
+                               [(day, hours[0], hours[1], hours[2], hours[3], place_id) for _, opening_hours in time_details for day, hours in opening_hours.items()])
+            cursor.execute("DELETE FROM opening_intervals WHERE place_id = ?", (place_id,))
+            cursor.executemany("INSERT INTO opening_intervals (place_id, start_minute, end_minute) VALUES (?, ?, ?)", [(place_id, start, end) for start, end in intervals])
+            cursor.execute("UPDATE places SET open_minute = ?, close_minute = ? WHERE place_id = ?", (open, close, place_id))
 
-    # Insert the photo into the database
-    sql_command = "INSERT INTO photos (photo_reference, height, width, place_id) VALUES (?, ?, ?, ?)"
-    cursor.execute(sql_command, (photo_reference, height, width, place_id))
-    
-    conn.commit()
-    conn.close()
+        if 'photo' in updated_fields:
+            cursor.execute("DELETE FROM photos WHERE place_id = ?", (place_id,))
+            cursor.executemany("INSERT INTO photos (photo_reference, height, width, place_id) VALUES (?, ?, ?, ?)", [(photo[1], photo[2], photo[3], photo[0]) for photo in photo_details])
 
-def insert_categories(place_id, types):
-    '''
-    Inserts categories into the database
-    '''
-    conn = sqlite3.connect('Databases/travel.db')
-    cursor = conn.cursor()
+        if 'type' in updated_fields:
+            categories = set([category for _, types in category_details for category in types])
+            cursor.execute("DELETE FROM place_categories WHERE place_id = ?", (place_id,))
+            cursor.executemany("INSERT INTO place_categories (place_id, category) VALUES (?, ?)", [(place_id, category) for category in categories])
+            cursor.execute("UPDATE places SET visit_minutes = ? WHERE place_id = ?", (visit_minutes(categories) if categories else None, place_id))
 
-    # Check if the column for the category exists
-    cursor.execute(f"PRAGMA table_info(categories)")
-    columns = cursor.fetchall()
-    column_names = [column[1] for column in columns]
-
-    # Insert the place with appropriate True/False values for each category
-    ind = 0
-    for category in types:
-        if category not in column_names:
-            add_category_column(conn, cursor, category)
-
-        # Check if the place is already in the database
-        if ind == 0:
-            sql_command = f"INSERT INTO categories ({category}, place_id) VALUES (?, ?)"
-            cursor.execute(sql_command, (1, place_id))
-        else:
-            sql_command = f"UPDATE categories SET {category} = ? WHERE place_id = ?"
-            cursor.execute(sql_command, (1, place_id))
-        ind += 1
-    
-    conn.commit()
-    conn.close()
+        fetched_at = int(time.time())
+        cursor.executemany("INSERT OR REPLACE INTO place_fields (place_id, field, fetched_at) VALUES (?, ?, ?)", [(place_id, field, fetched_at) for field in updated_fields])
 
-def add_category_column(conn, cursor, category):
+    refresh_catalog([place_id])
+
+def refresh_place_details(place_id):
     '''
-    Adds a column for a category in the categories table
+    Fetches the stale fields of the details of a known place and updates them, without any request if they are all fresh
+    Returns the fields that were refreshed
     '''
+    stale = stale_fields(place_id)
+    if not stale:
+        return []
 
-    # Add a column for the category
-    sql_command = f"ALTER TABLE categories ADD COLUMN {category} INTEGER NULL"
-    cursor.execute(sql_command)
+    place_details = fetch_place_details(place_id, stale)
+    if place_details is None:
+        return []
 
-    conn.commit()
+    place_details['place_id'] = place_id
+    update_place_fields(place_id, place_details, stale)
+    return stale
 
-def categories_including_filter(all_place_ids, filters):
+def opening_window(time_details):
     '''
-    Returns a list of places filtered by the categories in filters
+    Returns the opening intervals of a place in minutes of the week (Monday 00:00 is 0)
+    and its daily (open, close) window in minutes: the earliest opening and latest closing of the week
     '''
+    intervals = []
+    unknown = not time_details
+    for _, hours in time_details:
+        for day, (open_hour, open_minute, close_hour, close_minute) in hours.items():
+            if open_hour is None:
+                unknown = True
+                continue
+            if open_hour == 0 and open_minute == 0 and close_hour == 0 and close_minute == 0:
+                continue # Closed that day
 
-    if not filters:
-        return all_place_ids
+            start = open_hour * 60 + open_minute
+            end = close_hour * 60 + close_minute
+            if end <= start:
+                end += 1440 # Closes after midnight
+            day_start = WEEKDAYS.index(day) * 1440
+            intervals.append((day_start + start, day_start + end))
 
-    conn = sqlite3.connect('Databases/travel.db')
-    cursor = conn.cursor()
- 
-    # Get the names of all the columns in the categories table
-    cursor.execute("PRAGMA table_info(categories)")
-    columns = cursor.fetchall()
+    if unknown:
+        return intervals, DEFAULT_WINDOW
+    if not intervals:
+        return intervals, (1440, 1440) # Closed every day
+
+    open = min(start % 1440 for start, _ in intervals)
+    close = max(min(end - start // 1440 * 1440, 1440) for start, end in intervals)
+    return intervals, (open, close)
 
-    # Get the names of the categories
-    all_categories = [column[1] for column in columns if column[1] != 'place_id']
-    all_categories = set(all_categories)
+def places_within(points, radius_km):
+    '''
+    Returns the ids of the places within radius_km of at least one of the (lat, lng) points
+    The R*Tree returns the places in a bounding box around each point, the exact distance is checked after
+    '''
+    points = [(float(lat), float(lng)) for lat, lng in points]
+    if not points:
+        return []
 
-    # If the filtering category is not in the database drop it
-    filters = set(filters) & all_categories
+    conn = get_connection()
+    cursor = conn.cursor()
 
-    if not filters:
+    boxes = []
+    lat_delta = math.degrees(radius_km * 1000 / EARTH_R_METERS)
+    for lat, lng in points:
+        # A degree of longitude gets shorter towards the poles
+        cos_lat = math.cos(math.radians(min(abs(lat) + lat_delta, 90)))
+        lng_delta = 180 if cos_lat < 1e-6 else min(math.degrees(radius_km * 1000 / (EARTH_R_METERS * cos_lat)), 180)
+        boxes += [lat - lat_delta, lat + lat_delta, lng - lng_delta, lng + lng_delta]
+
+    box = "SELECT id FROM places_rtree WHERE max_lat >= ? AND min_lat <= ? AND max_lng >= ? AND min_lng <= ?"
+    query = f"SELECT p.place_id, p.lat, p.lng FROM places p WHERE p.id IN ({' UNION '.join([box] * len(points))})"
+    cursor.execute(query, boxes)
+    rows = cursor.fetchall()
+    if not rows:
         return []
 
-    query = f"SELECT place_id FROM categories WHERE {' OR '.join([f'{category} = 1' for category in filters])}" #AND place_id IN ({', '.join(['?'] * len(all_place_ids))})"
-    #cursor.execute(query, all_place_ids)
-    cursor.execute(query)
-    place_ids = set([place[0] for place in cursor.fetchall()])
-    place_ids = place_ids & set(all_place_ids)
-    
-    conn.commit()
-    conn.close()
-    
-    return list(place_ids)
+    distances = haversine_pairs([(lat, lng) for _, lat, lng in rows], points)
+    within = distances.min(axis=1) <= radius_km * 1000
+    return [row[0] for row, keep in zip(rows, within) if keep]
 
-def categories_excluding_filter(all_place_ids, filters):
+def create_travel_times_table(cursor):
     '''
-    Returns a list of places filtered by the categories not in filters
+    Creates the cache of travel distances/times between pairs of places if it doesn't exist
     '''
-    if not filters:
-        return all_place_ids
-    
-    conn = sqlite3.connect('Databases/travel.db')
-    cursor = conn.cursor()
+    sql_command = "CREATE TABLE IF NOT EXISTS travel_times (    \
+                    place_a TEXT,                               \
+                    place_b TEXT,                               \
+                    mode TEXT,                                  \
+                    meters INTEGER NULL,                        \
+                    seconds INTEGER NULL,                       \
+                    source TEXT,                                \
+                    fetched_at INTEGER,                         \
+                    PRIMARY KEY (place_a, place_b, mode)        \
+                    ) WITHOUT ROWID"
+    cursor.execute(sql_command)
 
-    # Get the names of all the columns in the categories table
-    cursor.execute("PRAGMA table_info(categories)")
-    columns = cursor.fetchall()
+def get_travel_times(place_keys, mode, sources = None):
+    '''
+    Returns the cached {(place_a, place_b): (meters, seconds)} between every pair of the given places
+    for a transport mode, optionally only the ones coming from the given sources
+    '''
+    if not place_keys:
+        return {}
 
+    conn = get_connection()
+    cursor = conn.cursor()
+    create_travel_times_table(cursor)
 
-    # Get the names of the categories
-    all_categories = [column[1] for column in columns if column[1] != 'place_id']
-    all_categories = set(all_categories)
+    # Join on a temporary table of keys so any number of places can be looked up at once
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS travel_keys (key TEXT PRIMARY KEY)")
+    cursor.execute("DELETE FROM travel_keys")
+    cursor.executemany("INSERT OR IGNORE INTO travel_keys (key) VALUES (?)", [(key,) for key in place_keys])
 
-    # If the filtering category is not in the database drop it
-    filters = set(filters) & all_categories
+    query = "SELECT t.place_a, t.place_b, t.meters, t.seconds, t.source FROM travel_times t  \
+             JOIN travel_keys a ON a.key = t.place_a                                        \
+             JOIN travel_keys b ON b.key = t.place_b                                        \
+             WHERE t.mode = ?"
+    cursor.execute(query, (mode,))
 
-    if not filters:
-        return all_place_ids
+    travel_times = {}
+    for place_a, place_b, meters, seconds, source in cursor.fetchall():
+        if sources is None or source in sources:
+            travel_times[(place_a, place_b)] = (meters, seconds)
 
-    query = f"SELECT place_id FROM categories WHERE {' AND '.join([f'{category} = 1' for category in filters])}" #AND place_id IN ({', '.join(['?'] * len(all_place_ids))})"
-    cursor.execute(query)
-    place_ids = set([place[0] for place in cursor.fetchall()])
-    place_ids = place_ids & set(all_place_ids)
-    place_ids = set(all_place_ids) - place_ids
-    
-    conn.commit()
-    conn.close()
-    
-    return list(place_ids)
+    conn.rollback() # Discard the temporary keys
+
+    return travel_times
 
-def budget_filter(all_place_ids, budget):
+def insert_travel_times(travel_times):
     '''
-    Returns a list of places filtered by the budget
+    Inserts or updates (place_a, place_b, mode, meters, seconds, source) rows in the travel times cache
     '''
-    conn = sqlite3.connect('Databases/travel.db')
+    if not travel_times:
+        return
+
+    conn = get_connection()
     cursor = conn.cursor()
-    query = f"SELECT place_id FROM places WHERE (price_level < ? OR price_level IS NULL) AND place_id IN ({', '.join(['?'] * len(all_place_ids))})"
-    cursor.execute(query, (budget,) + tuple(all_place_ids))
-    place_ids = set([place[0] for place in cursor.fetchall()])
-    
+    create_travel_times_table(cursor)
+
+    fetched_at = int(time.time())
+    sql_command = "INSERT INTO travel_times (place_a, place_b, mode, meters, seconds, source, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?) \
+                   ON CONFLICT (place_a, place_b, mode) DO UPDATE SET                                                                \
+                   meters = excluded.meters, seconds = excluded.seconds, source = excluded.source, fetched_at = excluded.fetched_at"
+    cursor.executemany(sql_command, [tuple(row) + (fetched_at,) for row in travel_times])
+
     conn.commit()
-    conn.close()
-    
-    return list(place_ids)
 
 def clean_matrix(place_ids, matrix):
     '''
     Cleans the distance matrix into distance and time matrix
+    Pairs without a route are left as None
     '''
 
-    distances = [[0 for _ in range(len(place_ids))] for _ in range(len(place_ids))]
-    times = [[0 for _ in range(len(place_ids))] for _ in range(len(place_ids))]
+    distances = [[None for _ in row['elements']] for row in matrix['rows']]
+    times = [[None for _ in row['elements']] for row in matrix['rows']]
+
+    for i, row in enumerate(matrix['rows']):
+        for j, element in enumerate(row['elements']):
+            if element.get('status', 'OK') != 'OK':
+                continue
 
-    for i, origin in enumerate(matrix['origin_addresses']):
-        for j, destination in enumerate(matrix['destination_addresses']):
             # Get the distance and time between the origin and destination
-            distance = matrix['rows'][i]['elements'][j]['distance']['value']
-            time_X = matrix['rows'][i]['elements'][j]['duration']['value']
+            distance = element['distance']['value']
+            time_X = element['duration']['value']
 
             # Save distance and time in arrays
             distances[i][j] = distance
-            times[i][j] = time
+            times[i][j] = time_X
 
     return distances, times
     
 
-def get_routes(place_ids, mode = 'driving'):
+def fetch_travel_times(place_ids, mode = 'driving'):
     '''
-    Returns a matrix of all distances/times between each pair of places
-    Distances in meters, time in seconds
+    Returns {(place_a, place_b): (meters, seconds)} between every pair of places, (None, None) if it has no route
+
+    Pairs already fetched from Google are read from the travel_times cache,
+    only the missing ones are requested from the Distance Matrix API and cached (including the ones without a route)
     '''
     # Get longtitude and latitude of each place from the database
-    conn = sqlite3.connect('Databases/travel.db')
+    conn = get_connection()
     cursor = conn.cursor()
 
     # Get the places
-    cursor.execute("SELECT lat, lng FROM places WHERE place_id IN ({})".format(','.join(['?'] * len(place_ids))), place_ids)
-    places = cursor.fetchall()
+    cursor.execute("SELECT place_id, lat, lng FROM places WHERE place_id IN ({})".format(','.join(['?'] * len(place_ids))), place_ids)
+    coordinates = {place_id: (lat, lng) for place_id, lat, lng in cursor.fetchall()}
 
-    gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
+    cached = get_travel_times(place_ids, mode, sources = ('google',))
+    missing_origins = [origin for origin in place_ids if any(origin != destination and (origin, destination) not in cached for destination in place_ids)]
 
-    # Get the distance between each pair of places
+    if missing_origins:
+        # The API accepts at most 25 destinations and 100 elements per request
+        fetched = []
+        for dest_start in range(0, len(place_ids), 25):
+            destinations = place_ids[dest_start:dest_start + 25]
+            origins_per_request = max(1, 100 // len(destinations))
+            for origin_start in range(0, len(missing_origins), origins_per_request):
+                origins = missing_origins[origin_start:origin_start + origins_per_request]
+
+                matrix = call_with_retries(gmaps.distance_matrix, [coordinates[origin] for origin in origins], [coordinates[destination] for destination in destinations],
+                                           mode = mode, should_retry = is_retriable)
+                distances, times = clean_matrix(place_ids, matrix)
+
+                for i, origin in enumerate(origins):
+                    for j, destination in enumerate(destinations):
+                        if origin != destination and (origin, destination) not in cached:
+                            cached[(origin, destination)] = (distances[i][j], times[i][j])
+                            fetched.append((origin, destination, mode, distances[i][j], times[i][j], 'google'))
+
+        insert_travel_times(fetched)
+
+    return cached
+
+def get_routes(place_ids, mode = 'driving'):
+    '''
+    Returns a matrix of all distances/times between each pair of places (see fetch_travel_times)
+    Distances in meters, time in seconds
+    '''
+    cached = fetch_travel_times(place_ids, mode)
 
-    matrix = gmaps.distance_matrix(places, places, mode = mode)
-    distances, times = clean_matrix(place_ids, matrix)
+    # Get the distance between each pair of places
+    distances = [[0 for _ in range(len(place_ids))] for _ in range(len(place_ids))]
+    times = [[0 for _ in range(len(place_ids))] for _ in range(len(place_ids))]
+    for i, origin in enumerate(place_ids):
+        for j, destination in enumerate(place_ids):
+            if i != j:
+                distances[i][j], times[i][j] = cached.get((origin, destination), (None, None))
             
     return distances, times
 
 
-def get_average_time(place_id):
+def visit_minutes(categories):
     '''
-    Get average time spent at a place based on the categories of the place
+    Returns the average time spent at a place with these categories in whole minutes (the solver needs integers),
+    60 minutes if none of them has a known time
     '''
-    conn = sqlite3.connect('Databases/travel.db')
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT * FROM categories WHERE place_id = ?", (place_id,))
-    categories = cursor.fetchone()
-    time_spent = 0
-    counter = 0
-    for category in categories:
-        if category == 1:
-            if category not in time_spent_per_category:
-                continue
-            time_spent += time_spent_per_category[category]
-            counter += 1
-    
-    if counter != 0:
-        return time_spent / counter
+    times = [time_spent_per_type[category] for category in categories if category in time_spent_per_type]
+    if times:
+        return int(sum(times) / len(times) + 0.5) # rounds half up like ROUND in SQLite
     else:
-        return 60 # 2 hour default
+        return 60 # 1 hour default
 
+def query_candidates(place_ids, filters_including, filters_excluding, budget_level):
+    '''
+    Returns the (place_id, name, lat, lng, open_minute, close_minute, visit_minutes) of the places
+    with these ids that pass the category and budget filters, ordered by places.id
 
+    The filters and the places with their daily opening window (precomputed at ingestion,
+    see opening_window) and visit time are all resolved by a single query
+    '''
+
+    conn = get_connection()
+    cursor = conn.cursor()
 
+    # Candidates go in a temporary table so there is no limit on their number
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS candidates (place_id TEXT PRIMARY KEY)")
+    cursor.execute("DELETE FROM candidates")
+    cursor.executemany("INSERT OR IGNORE INTO candidates (place_id) VALUES (?)", [(place_id,) for place_id in place_ids])
+
+    filters_including = list(set(filters_including))
+    filters_excluding = list(set(filters_excluding))
+    including = ', '.join(['?'] * len(filters_including))
+    excluding = ', '.join(['?'] * len(filters_excluding))
+
+    # Visit times of places scraped before visit_minutes existed are averaged over their categories, in whole minutes
+    category_minutes = ', '.join(['(?, ?)'] * len(time_spent_per_type))
+    visit = "CAST(COALESCE(p.visit_minutes, ROUND((SELECT AVG(m.minutes) FROM place_categories pc JOIN category_minutes m ON m.category = pc.category WHERE pc.place_id = p.place_id)), 60) AS INTEGER)"
+
+    # Places with all of the excluded categories that exist in the database (none if no category exists)
+    query = f"WITH category_minutes (category, minutes) AS (VALUES {category_minutes}),                                  \
+              excluded AS (                                                                                               \
+                SELECT place_id FROM place_categories WHERE category IN ({excluding}) GROUP BY place_id                   \
+                HAVING COUNT(*) = (SELECT COUNT(DISTINCT category) FROM place_categories WHERE category IN ({excluding}))  \
+              )                                                                                                           \
+              SELECT p.place_id, p.name, p.lat, p.lng, p.open_minute, p.close_minute, {visit}                             \
+              FROM candidates c                                                                                           \
+              JOIN places p ON p.place_id = c.place_id                                                                    \
+              WHERE (p.price_level < ? OR p.price_level IS NULL)                                                          \
+              AND p.place_id NOT IN excluded"
+    params = [value for item in time_spent_per_type.items() for value in item]
+    params += filters_excluding + filters_excluding + [budget_level]
+
+    # Places with at least one of the included categories
+    if filters_including:
+        query += f" AND p.place_id IN (SELECT place_id FROM place_categories WHERE category IN ({including}))"
+        params += filters_including
+
+    query += " ORDER BY p.id"
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    conn.rollback() # Discard the temporary candidates
+
+    return rows
 
 def get_routes_simple(place_ids, sleep_time, wake_time, filters_including, filters_excluding, budget_level = 2):
     '''
     Returns longtitude latitude of the places with these ids
-    '''
-
-    conn = sqlite3.connect('Databases/travel.db')
-    cursor = conn.cursor()
-
-    #print("Before any filtering", place_ids, "\n\n")
-    place_ids = categories_including_filter(place_ids, filters_including)
-    #print("include filtering", place_ids, "\n\n")
-    place_ids = categories_excluding_filter(place_ids, filters_excluding)
-    #print("exclude filtering", place_ids, "\n\n")
-    place_ids = budget_filter(place_ids, budget_level)
 
+    The places are filtered by the in-memory catalog when it is loaded, by the database otherwise
+    '''
 
-    # Get the places
-    cursor.execute("SELECT place_id, name, lat, lng FROM places WHERE place_id IN ({})".format(','.join(['?'] * len(place_ids))), place_ids)
-    places = cursor.fetchall()
-
-
-    # Get opening close times of the places
-    cursor.execute("SELECT place_id, day, open_hour, open_minute, close_hour, close_minute FROM time WHERE place_id IN ({})".format(','.join(['?'] * len(place_ids))), place_ids)
-    times = cursor.fetchall()
-
-    # Truncate to min opening hour min opening max close hour max close min for each place over all weeks
-    # Calculate the mind opening time and max closing time for each place_id
-    truncated_times = {}
-    for time in times:
-        place_id, day, open_hour, open_minute, close_hour, close_minute = time
-        if not truncated_times.get(place_id):
-            truncated_times[place_id] = [24, 60, 0, 0]
-
-        if open_hour is None:
-            truncated_times[place_id][0] = 9
-            truncated_times[place_id][1] = 0
-            truncated_times[place_id][2] = 17
-            truncated_times[place_id][3] = 0
-        elif open_hour == 0 and open_minute == 0 and close_minute == 0 and close_hour == 0:
-            continue
-        elif open_hour < truncated_times[place_id][0]:
-            truncated_times[place_id][0] = open_hour
-            truncated_times[place_id][1] = open_minute
-        elif open_hour == truncated_times[place_id][0] and open_minute < truncated_times[place_id][1]:
-            truncated_times[place_id][1] = open_minute
-        elif close_hour > truncated_times[place_id][2]:
-            truncated_times[place_id][2] = close_hour
-            truncated_times[place_id][3] = close_minute
-        elif close_hour == truncated_times[place_id][2] and close_minute > truncated_times[place_id][3]:
-            truncated_times[place_id][3] = close_minute
-    
-    for place_id in truncated_times:
-        truncated_times[place_id] = [truncated_times[place_id][0] * 60 + truncated_times[place_id][1], truncated_times[place_id][2] * 60 + truncated_times[place_id][3]]
-        truncated_times[place_id] = sleep_time_truncate(sleep_time, wake_time, truncated_times[place_id][0], truncated_times[place_id][1])
+    catalog = get_catalog()
+    if catalog is not None:
+        rows = catalog.select(place_ids, filters_including, filters_excluding, budget_level)
+    else:
+        rows = query_candidates(place_ids, filters_including, filters_excluding, budget_level)
 
     ans = []
-    for place in places:
-        open, close = truncated_times[place[0]]
+    for place_id, name, lat, lng, open, close, avg in rows:
+        # Places scraped before the windows existed count as open 9 to 5
+        if open is None or close is None:
+            open, close = DEFAULT_WINDOW
+        open, close = sleep_time_truncate(sleep_time, wake_time, open, close)
+
         if open > 1440:
             open = 1440
         if close > 1440:
             close = 1440
         if close < open:
             close = 1440
-        avg = get_average_time(place[0])
-        ans.append((place[0], place[1], float(place[2]), float(place[3]), open, close, avg))
-    
-    conn.commit()
-    conn.close()
+        ans.append((place_id, name, float(lat), float(lng), open, close, avg))
 
     return ans
 
+def create_geocode_cache_table(cursor):
+    '''
+    Creates the cache of reverse geocoding results if it doesn't exist
+    '''
+    sql_command = "CREATE TABLE IF NOT EXISTS geocode_cache (      \
+                    key TEXT PRIMARY KEY,                          \
+                    result TEXT,                                   \
+                    fetched_at INTEGER                             \
+                    ) WITHOUT ROWID"
+    cursor.execute(sql_command)
+
+def geocode_key(lat, lng):
+    '''
+    Returns the cache key of coordinates
+    '''
+    return f"{float(lat):.{GEOCODE_DECIMALS}f},{float(lng):.{GEOCODE_DECIMALS}f}"
+
+def reverse_geocode(lat, lng):
+    '''
+    Returns the reverse geocoding results of the coordinates, from the cache if they were fetched less than GEOCODE_TTL ago
+    '''
+    key = geocode_key(lat, lng)
+    now = time.time()
+
+    with geocode_lock:
+        entry = geocode_memory.get(key)
+        if entry and now - entry[0] < GEOCODE_TTL:
+            geocode_memory.move_to_end(key)
+            return entry[1]
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    create_geocode_cache_table(cursor)
+    cursor.execute("SELECT fetched_at, result FROM geocode_cache WHERE key = ?", (key,))
+    row = cursor.fetchone()
+
+    if row and now - row[0] < GEOCODE_TTL:
+        fetched_at, result = row[0], json.loads(row[1])
+    else:
+        fetched_at, result = int(now), call_with_retries(gmaps.reverse_geocode, (lat, lng), should_retry = is_retriable)
+        if result:
+            sql_command = "INSERT INTO geocode_cache (key, result, fetched_at) VALUES (?, ?, ?) \
+                           ON CONFLICT (key) DO UPDATE SET result = excluded.result, fetched_at = excluded.fetched_at"
+            cursor.execute(sql_command, (key, json.dumps(result), fetched_at))
+    conn.commit()
+
+    if result:
+        with geocode_lock:
+            geocode_memory[key] = (fetched_at, result)
+            geocode_memory.move_to_end(key)
+            while len(geocode_memory) > GEOCODE_MEMORY_SIZE:
+                geocode_memory.popitem(last=False)
+
+    return result
+
 def get_city_country(lat, lng):
     '''
     Returns the city and country from the latitude and longtitude
     '''
 
-    reverse_geocode = gmaps.reverse_geocode((lat, lng))
+    results = reverse_geocode(lat, lng)
     city = None
     country = None
 
-    for component in reverse_geocode[0]['address_components']:
+    for component in results[0]['address_components']:
         if 'locality' in component['types']:
             city = component['long_name']
         if 'country' in component['types']:
@@ -567,11 +807,15 @@ def get_city_country(lat, lng):
     return city, country
     
 
-def get_attractions_user_input(info):
+def get_attractions_user_input(info, ingest_queue = None, jobs = None):
     '''
     Returns a list of tourist attractions based on user input
     And gets nearby places to each of them
     List of longtitudes and latitudes
+
+    With an ingest_queue, cities whose scraping never finished are queued instead of scraped right away
+    and only the known places around are candidates for now. The jobs of the cities still being
+    scraped are appended to jobs
     '''
     required_locations = info['must_locations']
     required_names_list = info['must_names']
@@ -591,12 +835,11 @@ def get_attractions_user_input(info):
     places_unique = set()
 
     # Getting all ids from the places table
-    conn = sqlite3.connect('Databases/travel.db')
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT place_id FROM places")
     all_ids = cursor.fetchall()
     conn.commit()
-    conn.close()
     
     # Keeping track of all ids in the set
     places_unique = set([place[0] for place in all_ids])
@@ -605,55 +848,57 @@ def get_attractions_user_input(info):
     for i in range(len(required_locations)):
         lat, lng = required_locations[i]
         city, country = get_city_country(lat, lng)
+        known_city = city_exists(city, country)
         
-        if city_exists(city, country):
-            # Get the place_ids in the city
-            conn = sqlite3.connect('Databases/travel.db')
-            cursor = conn.cursor()
-            cursor.execute("SELECT place_id FROM places WHERE city_id = (SELECT id FROM cities WHERE name = ?)", (city,))
-            all_places = cursor.fetchall()
-            conn.commit()
-            conn.close()
-
-            place_ids = [place[0] for place in all_places]
+        if known_city and city_scraped(known_city[0]):
+            # Get the known place_ids around the hotel and this place
+            place_ids = places_within([(lat, lng), info['hotel_loc']], CANDIDATE_RADIUS_KM)
             
             places_unique.update(place_ids)
 
             # All place_ids are added to optional attractions
             optional_attractions.update(place_ids)       
+        elif ingest_queue is not None:
+            # Scrape the city in the background (again if its last scraping didn't finish)
+            # and use the known places around for now
+            city_id = known_city[0] if known_city else insert_city(city, country)
+            job = ingest_queue.submit(lat, lng, city, country, city_id)
+            if jobs is not None:
+                jobs.append(job)
+
+            place_ids = places_within([(lat, lng), info['hotel_loc']], CANDIDATE_RADIUS_KM)
+            places_unique.update(place_ids)
+            optional_attractions.update(place_ids)
         else:
             # Update the database
-            new_ids = update_city(lat, lng, city, country)
+            new_ids = update_city(lat, lng, city, country, known_city[0] if known_city else None)
             optional_attractions.update(new_ids)
 
         # Add the place to required attractions
-        req_place = gmaps.reverse_geocode((lat, lng))
+        req_place = reverse_geocode(lat, lng)
         req_id = req_place[0]['place_id']
-        req_details = gmaps.place(place_id = req_id, fields = fields)['result']
-        
-        formatted_details, time_details, photo_details, category_details  = clean_data(req_details)
-        formatted_details['name'] = required_names_list[i]
         
         required_attractions.add(req_id)
         ranked_attractions.append(req_id)
 
         if req_id in places_unique:
+            # Known places are only fetched again for their stale fields
+            refresh_place_details(req_id)
+
             # Update this req_id name in places_unique
-            conn = sqlite3.connect('Databases/travel.db')
+            conn = get_connection()
             cursor = conn.cursor()
             cursor.execute("UPDATE places SET name = ? WHERE place_id = ?", (required_names_list[i], req_id))
             conn.commit()
-            conn.close()
+            refresh_catalog([req_id])
         else:
+            req_details = call_with_retries(gmaps.place, place_id = req_id, fields = fields, should_retry = is_retriable, bucket = places_bucket)['result']
+            formatted_details, time_details, photo_details, category_details  = clean_data(req_details)
+            formatted_details['name'] = required_names_list[i]
+
             city_id = city_exists(city, country)[0]
             places_unique.add(req_id)
-            insert_place(city_id, [formatted_details])
-            for time in time_details:
-                insert_time(time[0], time[1])
-            for photo in photo_details:
-                insert_photos(photo[0], photo[1], photo[2], photo[3])
-            for category in category_details:
-                insert_categories(category[0], category[1])
+            insert_places_batch(city_id, [[formatted_details, time_details, photo_details, category_details]])
 
 
     # Remove required attractions from optional attractions
@@ -669,13 +914,47 @@ def get_attractions_user_input(info):
 
 
 
-def update_city(lat, lng, city, country):
+def is_retriable(error):
+    '''
+    Returns whether a failed Google Maps request can succeed if it is sent again
+    '''
+    if isinstance(error, (googlemaps.exceptions.Timeout, googlemaps.exceptions.TransportError)):
+        return True
+    return isinstance(error, googlemaps.exceptions.ApiError) and error.status in ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR')
+
+def is_page_token_pending(error):
+    '''
+    Returns whether a nearby search failed because its next_page_token isn't valid yet
+    '''
+    return (isinstance(error, googlemaps.exceptions.ApiError) and error.status == 'INVALID_REQUEST') or is_retriable(error)
+
+def fetch_place_details(place_id, requested_fields = fields):
+    '''
+    Returns the details of a place (only the requested fields), None if they can't be fetched
+    '''
+    try:
+        return call_with_retries(gmaps.place, place_id = place_id, fields = requested_fields, should_retry = is_retriable, bucket = places_bucket)['result']
+    except Exception as e:
+        print(f"Skipping place {place_id}, its details can't be fetched: {e}")
+        return None
+
+def fetch_next_page(params, page_token):
+    '''
+    Returns the next page of a nearby search as soon as its token is valid
+    Google only accepts a next_page_token a short time after returning it, so early attempts are retried
+    '''
+    return call_with_retries(gmaps.places_nearby, **params, page_token = page_token, retries = 8, backoff = 0.25, max_backoff = 2,
+                             should_retry = is_page_token_pending, bucket = places_bucket)
+
+def update_city(lat, lng, city, country, city_id = None):
     '''
     Updates the touristic places in the city and returns their place_ids
+    The details of the places of a page are fetched in parallel while the next page is requested
     '''
 
-    # Insert the city and its places into the database
-    city_id = insert_city(city, country)
+    # Insert the city (unless it already was) and its places into the database
+    if city_id is None:
+        city_id = insert_city(city, country)
     place_ids = set()
     
     # Define parameters for nearby search
@@ -688,44 +967,40 @@ def update_city(lat, lng, city, country):
     max_iteration = 3 # Adjust in the future
     iteration = 0
 
-    while iteration < max_iteration:
+    with ThreadPoolExecutor(max_workers = DETAILS_WORKERS) as pool:
         # Perform nearby search
-        places = gmaps.places_nearby(**params)
+        places = call_with_retries(gmaps.places_nearby, **params, should_retry = is_retriable, bucket = places_bucket)
 
-        # Extract and return information about tourist attractions
-        for place in places['results']:
+        while True:
             # Get place details
-            place_id = place['place_id']
-            place_details = gmaps.place(place_id = place_id, fields = fields)['result']
-
-            # Clean the place details
-            place_details = clean_data(place_details)
+            details_jobs = [pool.submit(fetch_place_details, place['place_id']) for place in places['results']]
 
+            # Check if there are more results to fetch
+            next_page = None
+            if 'next_page_token' in places and iteration < max_iteration - 1:
+                next_page = pool.submit(fetch_next_page, params, places['next_page_token'])
+                iteration += 1
 
             # Clean the place details
-            formatted_details, time_details, photo_details, category_details  = place_details
-            
-            # Insert everything in the database
-            insert_place(city_id, [formatted_details])
-            for _times in time_details:
-                insert_time(_times[0], _times[1])
-            for photo in photo_details:
-                insert_photos(photo[0], photo[1], photo[2], photo[3])
-            for category in category_details:
-                insert_categories(category[0], category[1])
-            
-
-            place_ids.add(place_id)
-
-        
-        # Check if there are more results to fetch
-        if 'next_page_token' in places:
-            # Wait for a few seconds before making the next request
-            time.sleep(2)
-            params['page_token'] = places['next_page_token']
-            iteration += 1
-        else:
-            break
+            page = []
+            for job in details_jobs:
+                place_details = job.result()
+                if place_details is not None:
+                    page.append(clean_data(place_details))
+                    place_ids.add(place_details['place_id'])
+
+            # Insert the whole page in the database at once
+            if page:
+                insert_places_batch(city_id, page)
+
+            if next_page is None:
+                break
+            places = next_page.result()
+
+    # Only a city whose scraping finished is planned with its known places alone
+    conn = get_connection()
+    with conn:
+        conn.execute("UPDATE cities SET scraped_at = ? WHERE id = ?", (int(time.time()), city_id))
         
     return place_ids
 
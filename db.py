@@ -0,0 +1,53 @@
+"""
+Shared access to the travel database
+
+Each thread keeps one long-lived connection per database (reopened after a fork)
+instead of opening a new one in every helper. Connections use WAL journaling so
+readers don't block behind the scraper's writes.
+"""
+
+import importlib.util
+import os
+import sqlite3
+import threading
+
+DB_PATH = 'Databases/travel.db'
+
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",        # readers and one writer work concurrently
+    "PRAGMA synchronous = NORMAL",      # safe with WAL, only the checkpoints are fsynced
+    "PRAGMA busy_timeout = 5000",       # wait up to 5s for a lock instead of failing
+    "PRAGMA cache_size = -20000",       # 20MB page cache per connection
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",     # read pages through a 256MB memory map
+]
+
+_local = threading.local()
+
+def get_connection(db_path = DB_PATH):
+    '''
+    Returns the connection of the current thread to the database, opening it on first use
+    '''
+    # Connections can't be shared with a forked child, it opens its own
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+
+    conn = _local.connections.get(db_path)
+    if conn is None:
+        conn = sqlite3.connect(db_path)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        _local.connections[db_path] = conn
+
+    return conn
+
+def migrate_database(db_path = DB_PATH):
+    '''
+    Upgrades the database to the latest schema with the migrations of Databases/create-databases.py
+    and returns its version. Migrations already applied are skipped, so it is safe to call on every start
+    '''
+    spec = importlib.util.spec_from_file_location('create_databases', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Databases', 'create-databases.py'))
+    create_databases = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(create_databases)
+    return create_databases.migrate(db_path)
@@ -0,0 +1,54 @@
+"""
+Batched Haversine distances between (latitude, longitude) points
+
+The whole matrix is computed at once on float arrays instead of one pair at a time.
+For very large inputs the rows are computed in chunks so memory stays bounded.
+"""
+
+import numpy as np
+
+EARTH_R_METERS = 6371e3
+DEFAULT_CHUNK_ROWS = 1024 # rows computed at once when the matrix gets large
+
+def haversine_pairs(from_coords, to_coords):
+    '''
+    Returns a float matrix of the distances in meters between every point of
+    from_coords (rows) and every point of to_coords (columns)
+    '''
+    from_rad = np.radians(np.asarray(from_coords, dtype=np.float64).reshape(-1, 2))
+    to_rad = np.radians(np.asarray(to_coords, dtype=np.float64).reshape(-1, 2))
+
+    phi1 = to_rad[:, 0][np.newaxis, :]  # phi, lambda in radians
+    phi2 = from_rad[:, 0][:, np.newaxis]
+    phi_diff = phi2 - phi1 # latitude diff
+    lambda_diff = from_rad[:, 1][:, np.newaxis] - to_rad[:, 1][np.newaxis, :] # longitude diff
+
+    a = np.sin(phi_diff / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(lambda_diff / 2) ** 2
+    a = np.clip(a, 0, 1) # rounding can push a slightly outside [0, 1]
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+    return EARTH_R_METERS * c
+
+def haversine_matrix(coords, chunk_rows=None, dtype=np.int32):
+    '''
+    Returns the square matrix of distances in meters between all the given points,
+    truncated to integers.
+
+    When chunk_rows is given (or the matrix is larger than DEFAULT_CHUNK_ROWS),
+    only chunk_rows rows of floats are alive at any time.
+    '''
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    num_points = len(coords)
+
+    if chunk_rows is None:
+        chunk_rows = DEFAULT_CHUNK_ROWS
+    chunk_rows = max(1, int(chunk_rows))
+
+    if num_points <= chunk_rows:
+        return haversine_pairs(coords, coords).astype(dtype)
+
+    distance_matrix = np.empty((num_points, num_points), dtype=dtype)
+    for start in range(0, num_points, chunk_rows):
+        end = min(start + chunk_rows, num_points)
+        distance_matrix[start:end] = haversine_pairs(coords[start:end], coords)
+    return distance_matrix
@@ -0,0 +1,73 @@
+"""
+Evaluation sweep over trip lengths and transport modes
+
+The distance matrix is computed once, the time matrix of each transport mode is derived
+from it, and every (days, transport) configuration is solved in parallel in the solver pool.
+The report has one row per configuration and can be returned as JSON or CSV.
+"""
+
+import csv
+import io
+import math
+from concurrent.futures import wait
+from routing_basic import compute_distance_matrix, compute_time_matrix
+
+EVAL_DAYS = [1, 3, 5, 7, 10]
+EVAL_TRANSPORTS = ["public transport", "car", "walking", "bike"]
+
+REPORT_FIELDS = ['days', 'transport', 'objective', 'num_dropped', 'num_truncated', 'num_sites',
+                 'travel_time', 'visit_time', 'solve_seconds', 'stop_reason', 'error']
+
+def run_sweep(solver, required, optional, days_list=EVAL_DAYS, transports=EVAL_TRANSPORTS, timeout=None):
+    '''
+    Solves the trip for every number of days and transport mode and returns the report rows
+    '''
+    locations = required + optional
+    distance_matrix = compute_distance_matrix([(latitude, longitude) for _, _, latitude, longitude, _, _, _ in locations])
+    time_matrices = {transport: compute_time_matrix(transport, distance_matrix) for transport in transports}
+
+    timeout = timeout or solver.timeout
+    jobs = {}
+    for days in days_list:
+        for transport in transports:
+            job = solver.submit(required, optional, False, transport, days, timeout, time_matrix=time_matrices[transport])
+            jobs[job] = (days, transport)
+
+    # Jobs run max_workers at a time, each one within its own timeout
+    done, not_done = wait(jobs, timeout=timeout * math.ceil(len(jobs) / solver.max_workers))
+    solver.cancel(*not_done)
+
+    rows = []
+    for job, (days, transport) in jobs.items():
+        row = dict.fromkeys(REPORT_FIELDS)
+        row.update(days=days, transport=transport)
+
+        if job not in done:
+            row['error'] = 'timeout'
+        elif job.exception() is not None:
+            row['error'] = repr(job.exception())
+        else:
+            (_, travel_time, visit_time, num_sites), stats = job.result()
+            row.update(
+                objective=stats['objective'],
+                num_dropped=len(stats['dropped_nodes']),
+                num_truncated=stats['num_truncated'],
+                num_sites=num_sites,
+                travel_time=travel_time,
+                visit_time=visit_time,
+                solve_seconds=round(stats['solve_seconds'], 3),
+                stop_reason=stats['stop_reason'],
+            )
+        rows.append(row)
+
+    return rows
+
+def report_to_csv(rows):
+    '''
+    Returns the report rows as CSV text
+    '''
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=REPORT_FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue()
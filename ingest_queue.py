@@ -0,0 +1,147 @@
+"""
+Background queue of city scraping jobs
+
+A request whose must-see location is in a city that was never scraped doesn't wait for it:
+the city is queued here and the request plans with the places that are already known.
+Worker threads scrape the queued cities one at a time each, and the status of a job can be
+queried (see the /jobs/<job_id> route) so the user knows when refreshing gives a richer plan.
+
+Jobs are stored in the ingest_jobs table, so any web worker can answer the status of a job
+queued by another one, and the jobs that didn't finish are queued again after a restart.
+A running job is kept alive by a heartbeat, when it stops (its process died) another worker takes the job.
+"""
+
+import queue
+import threading
+import time
+import uuid
+from db import DB_PATH, get_connection
+
+JOB_COLUMNS = ['id', 'city', 'country', 'status', 'created_at', 'started_at', 'finished_at', 'num_places', 'error']
+
+class IngestQueue:
+    '''
+    Runs ingest(lat, lng, city, country, city_id) jobs (data_scraper.update_city) on worker threads.
+    A city has at most one queued or running job, submitting it again returns that job.
+    The last max_jobs jobs are kept to answer status queries.
+    '''
+
+    def __init__(self, ingest, workers=1, max_jobs=1000, db_path=DB_PATH, heartbeat=10, stale_after=60):
+        self.ingest = ingest
+        self.max_jobs = max_jobs
+        self.db_path = db_path
+        self.heartbeat = heartbeat      # seconds between the heartbeats of the running jobs
+        self.stale_after = stale_after  # seconds without a heartbeat before a running job is taken over
+        self.running = set()            # job_ids running on the threads of this process
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+        threading.Thread(target=self._beat, daemon=True).start()
+
+    def submit(self, lat, lng, city, country, city_id=None):
+        '''
+        Queues the scraping of a city and returns a copy of its job
+        '''
+        conn = get_connection(self.db_path)
+        now = time.time()
+        with conn:
+            # Under the write lock so two web workers can't both queue the city
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT id, status, heartbeat_at FROM ingest_jobs WHERE city IS ? AND country IS ? AND status IN ('queued', 'running')",
+                               (city, country)).fetchone()
+            if row is None:
+                job_id = uuid.uuid4().hex
+                conn.execute("INSERT INTO ingest_jobs (id, city_id, city, country, lat, lng, status, created_at) VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+                             (job_id, city_id, city, country, lat, lng, now))
+                self._forget_old_jobs(conn)
+                print(f"Queued the scraping of {city}, {country} (job {job_id})")
+            else:
+                job_id = row[0]
+
+        # The process that queued or was running the job may be gone, it is queued here too and
+        # whichever worker claims it first runs it
+        if row is None or row[1] == 'queued' or row[2] < now - self.stale_after:
+            self.queue.put(job_id)
+        return self.get(job_id)
+
+    def resume(self):
+        '''
+        Queues again the jobs that were queued or running when the website stopped and returns their number
+        '''
+        conn = get_connection(self.db_path)
+        rows = conn.execute("SELECT id FROM ingest_jobs WHERE status = 'queued' OR (status = 'running' AND heartbeat_at < ?) ORDER BY created_at",
+                            (time.time() - self.stale_after,)).fetchall()
+        for row in rows:
+            self.queue.put(row[0])
+        if rows:
+            print(f"Resumed {len(rows)} scraping jobs")
+        return len(rows)
+
+    def get(self, job_id):
+        '''
+        Returns a copy of a job, None if it doesn't exist (or was forgotten)
+        '''
+        conn = get_connection(self.db_path)
+        row = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM ingest_jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(zip(JOB_COLUMNS, row)) if row else None
+
+    def _forget_old_jobs(self, conn):
+        # Only finished jobs are forgotten, oldest first
+        conn.execute("DELETE FROM ingest_jobs WHERE status IN ('done', 'failed') AND id NOT IN (SELECT id FROM ingest_jobs ORDER BY created_at DESC LIMIT ?)",
+                     (self.max_jobs,))
+
+    def _claim(self, job_id):
+        # Returns the job if this thread is the one running it
+        conn = get_connection(self.db_path)
+        now = time.time()
+        with conn:
+            claimed = conn.execute("UPDATE ingest_jobs SET status = 'running', started_at = ?, heartbeat_at = ? \
+                                    WHERE id = ? AND (status = 'queued' OR (status = 'running' AND heartbeat_at < ?))",
+                                   (now, now, job_id, now - self.stale_after)).rowcount
+        if not claimed:
+            return None
+        return conn.execute("SELECT lat, lng, city, country, city_id FROM ingest_jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def _beat(self):
+        while True:
+            time.sleep(self.heartbeat)
+            with self.lock:
+                job_ids = list(self.running)
+            if not job_ids:
+                continue
+
+            try:
+                conn = get_connection(self.db_path)
+                with conn:
+                    conn.execute(f"UPDATE ingest_jobs SET heartbeat_at = ? WHERE id IN ({', '.join(['?'] * len(job_ids))})", [time.time()] + job_ids)
+            except Exception as e:
+                print(f"Heartbeat of the scraping jobs failed: {e!r}")
+
+    def _work(self):
+        while True:
+            job_id = self.queue.get()
+            job = self._claim(job_id)
+            if job is None:
+                # Already taken by another worker, finished or forgotten
+                self.queue.task_done()
+                continue
+
+            lat, lng, city, country, city_id = job
+            with self.lock:
+                self.running.add(job_id)
+
+            try:
+                place_ids = self.ingest(lat, lng, city, country, city_id)
+                update = ('done', len(place_ids), None)
+            except Exception as e:
+                print(f"Scraping {city}, {country} failed: {e!r}")
+                update = ('failed', None, repr(e))
+
+            with self.lock:
+                self.running.discard(job_id)
+            conn = get_connection(self.db_path)
+            with conn:
+                conn.execute("UPDATE ingest_jobs SET status = ?, num_places = ?, error = ?, finished_at = ? WHERE id = ?", update + (time.time(), job_id))
+            self.queue.task_done()
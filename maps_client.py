@@ -0,0 +1,283 @@
+"""
+Google Maps clients used by the scraper
+
+Anything with the places_nearby, place, reverse_geocode and distance_matrix methods of
+googlemaps.Client can be the client of data_scraper (data_scraper.gmaps). Besides the real
+client there are offline stand-ins to benchmark ingestion and /results without the network:
+
+- SyntheticClient generates a city of tourist attractions around any location
+- ReplayClient answers with responses recorded by RecordingClient
+
+Stand-ins add latency and inject errors (googlemaps exceptions) deterministically: the delay
+and the outcome of a request only depend on the seed, the request and how many times it was made.
+make_client builds the client named by the MAPS_CLIENT environment variable.
+"""
+
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+import googlemaps
+import googlemaps.exceptions
+import numpy as np
+from distances import haversine_pairs
+
+# Errors injected by the stand-ins, all of them are retried by data_scraper
+INJECTED_ERRORS = [
+    lambda: googlemaps.exceptions.Timeout(),
+    lambda: googlemaps.exceptions.TransportError(ConnectionError("Injected connection reset")),
+    lambda: googlemaps.exceptions.ApiError('OVER_QUERY_LIMIT'),
+]
+
+SYNTHETIC_CATEGORIES = ['museum', 'park', 'art_gallery', 'zoo', 'aquarium', 'amusement_park', 'place_of_worship',
+                        'stadium', 'library', 'cemetery', 'night_club', 'casino', 'book_store', 'spa']
+SYNTHETIC_HOURS = ['9:00 AM – 5:00 PM', '10:00 AM – 6:00 PM', '8:00 AM – 8:00 PM', '11:00 AM – 2:00 AM', 'Open 24 hours', 'Closed']
+SYNTHETIC_SPEEDS = {'driving': 8.0, 'walking': 1.4, 'bicycling': 4.0, 'transit': 6.0} # meters per second
+
+def request_key(method, **args):
+    '''
+    Returns the canonical key of a request, used to record and replay it
+    '''
+    return json.dumps([method, args], sort_keys=True, default=list)
+
+class StandInClient:
+    '''
+    Base of the offline clients: simulated latency, error injection and per-request statistics
+
+    latency is the median delay of a request in seconds and jitter the standard deviation of its log
+    (so a few requests are much slower than the median), error_rate the probability that it fails
+    '''
+
+    def __init__(self, latency=0, jitter=0, error_rate=0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.attempts = {}      # key -> number of times the request was made
+        self.latencies = {}     # method -> seconds of every request
+        self.errors = 0
+
+    def request(self, method, respond, **args):
+        '''
+        Simulates the request, then returns respond() or raises an injected error
+        '''
+        key = request_key(method, **args)
+        with self.lock:
+            attempt = self.attempts.get(key, 0)
+            self.attempts[key] = attempt + 1
+        rng = random.Random(f"{self.seed}:{key}:{attempt}")
+
+        delay = self.latency * math.exp(rng.gauss(0, self.jitter)) if self.latency else 0
+        time.sleep(delay)
+        failed = rng.random() < self.error_rate
+
+        with self.lock:
+            self.latencies.setdefault(method, []).append(delay)
+            self.errors += failed
+        if failed:
+            raise rng.choice(INJECTED_ERRORS)()
+        return respond()
+
+    def stats(self):
+        '''
+        Returns the number of requests, errors and latency percentiles (in ms) per method
+        '''
+        with self.lock:
+            stats = {'errors': self.errors}
+            for method, latencies in self.latencies.items():
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+                stats[method] = {'requests': len(latencies), 'p50_ms': round(float(p50), 1), 'p95_ms': round(float(p95), 1), 'p99_ms': round(float(p99), 1)}
+            return stats
+
+class SyntheticClient(StandInClient):
+    '''
+    Generates deterministic cities: every location has places_per_page * pages tourist attractions
+    within radius meters, with opening hours, categories, ratings and photos.
+    A next_page_token is accepted token_delay seconds after it was returned, like Google's.
+    '''
+
+    def __init__(self, places_per_page=20, pages=3, token_delay=0, **kwargs):
+        super().__init__(**kwargs)
+        self.places_per_page = places_per_page
+        self.pages = pages
+        self.token_delay = token_delay
+        self.tokens = {} # token -> time it becomes valid
+
+    def rng(self, *key):
+        return random.Random(hashlib.sha256(repr((self.seed,) + key).encode()).digest())
+
+    def places_nearby(self, location=None, radius=None, type=None, page_token=None, **kwargs):
+        def respond():
+            if page_token:
+                with self.lock:
+                    valid_at = self.tokens.get(page_token)
+                if valid_at is None or time.monotonic() < valid_at:
+                    raise googlemaps.exceptions.ApiError('INVALID_REQUEST')
+                center, page = page_token.rsplit(':', 1)
+                page = int(page)
+            else:
+                center, page = f"{float(location[0]):.4f},{float(location[1]):.4f}", 0
+
+            first = page * self.places_per_page
+            response = {'status': 'OK', 'results': [{'place_id': f"SYN:{center}:{radius or 20000}:{i}"} for i in range(first, first + self.places_per_page)]}
+            if page + 1 < self.pages:
+                token = f"{center}:{page + 1}"
+                with self.lock:
+                    self.tokens.setdefault(token, time.monotonic() + self.token_delay)
+                response['next_page_token'] = token
+            return response
+
+        return self.request('places_nearby', respond, location=location, radius=radius, type=type, page_token=page_token)
+
+    def place(self, place_id, fields=None, **kwargs):
+        def respond():
+            if not place_id.startswith('SYN:'):
+                raise googlemaps.exceptions.ApiError('NOT_FOUND')
+            _, center, radius, number = place_id.split(':')
+            lat, lng = [float(value) for value in center.split(',')]
+            rng = self.rng(place_id)
+
+            if number == 'geocoded':
+                name, distance = f"Landmark at {center}", 0
+            else:
+                name, distance = f"Synthetic attraction {number}", float(radius) * math.sqrt(rng.random())
+            bearing = rng.uniform(0, 2 * math.pi)
+            lat += math.degrees(distance * math.cos(bearing) / 6371e3)
+            lng += math.degrees(distance * math.sin(bearing) / 6371e3) / max(math.cos(math.radians(lat)), 1e-6)
+
+            weekday_text = [f"{day}: {rng.choice(SYNTHETIC_HOURS)}" for day in ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']]
+            details = {
+                'place_id': place_id,
+                'name': name,
+                'formatted_address': f"{number} Synthetic Street, {center}",
+                'rating': round(rng.uniform(3, 5), 1),
+                'opening_hours': {'weekday_text': weekday_text},
+                'photos': [{'photo_reference': f"photo-{place_id}", 'height': 1080, 'width': 1920}],
+                'geometry': {'location': {'lat': lat, 'lng': lng}},
+                'types': rng.sample(SYNTHETIC_CATEGORIES, rng.randint(1, 3)) + ['tourist_attraction', 'point_of_interest'],
+                'price_level': rng.choice([None, 0, 1, 2, 3]),
+                'user_ratings_total': rng.randint(10, 50000),
+                'url': f"https://maps.google.com/?cid={int(hashlib.sha256(place_id.encode()).hexdigest()[:12], 16)}",
+                'vicinity': center,
+            }
+
+            # Only the requested fields, named as in the API response
+            names = {'photo': 'photos', 'type': 'types'}
+            requested = set([names.get(field, field) for field in (fields or details)]) | {'place_id'}
+            return {'status': 'OK', 'result': {field: value for field, value in details.items() if field in requested and value is not None}}
+
+        return self.request('place', respond, place_id=place_id, fields=sorted(fields or []))
+
+    def reverse_geocode(self, latlng, **kwargs):
+        def respond():
+            lat, lng = float(latlng[0]), float(latlng[1])
+            return [{
+                'place_id': f"SYN:{lat:.4f},{lng:.4f}:0:geocoded",
+                'address_components': [
+                    {'long_name': f"Synthetic City {lat:.1f},{lng:.1f}", 'types': ['locality', 'political']},
+                    {'long_name': 'Synthetic Country', 'types': ['country', 'political']},
+                ],
+            }]
+
+        return self.request('reverse_geocode', respond, latlng=[float(latlng[0]), float(latlng[1])])
+
+    def distance_matrix(self, origins, destinations, mode='driving', **kwargs):
+        def respond():
+            # Roads are about 1.3 times longer than the straight line
+            meters = haversine_pairs(origins, destinations) * 1.3
+            seconds = meters / SYNTHETIC_SPEEDS.get(mode, SYNTHETIC_SPEEDS['driving'])
+            return {'status': 'OK', 'rows': [{'elements': [{'status': 'OK', 'distance': {'value': int(meters[i, j])}, 'duration': {'value': int(seconds[i, j])}}
+                                                            for j in range(len(destinations))]} for i in range(len(origins))]}
+
+        return self.request('distance_matrix', respond, origins=[list(map(float, origin)) for origin in origins],
+                            destinations=[list(map(float, destination)) for destination in destinations], mode=mode)
+
+class RecordingClient:
+    '''
+    Passes the requests to a client and appends their keys and responses to a JSON lines file
+    '''
+
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, method, response, **args):
+        with self.lock, open(self.path, 'a') as file:
+            file.write(json.dumps({'key': request_key(method, **args), 'response': response}) + '\n')
+        return response
+
+    def places_nearby(self, location=None, radius=None, type=None, page_token=None, **kwargs):
+        response = self.client.places_nearby(location=location, radius=radius, type=type, page_token=page_token, **kwargs)
+        return self.record('places_nearby', response, location=location, radius=radius, type=type, page_token=page_token)
+
+    def place(self, place_id, fields=None, **kwargs):
+        return self.record('place', self.client.place(place_id, fields=fields, **kwargs), place_id=place_id, fields=sorted(fields or []))
+
+    def reverse_geocode(self, latlng, **kwargs):
+        return self.record('reverse_geocode', self.client.reverse_geocode(latlng, **kwargs), latlng=[float(latlng[0]), float(latlng[1])])
+
+    def distance_matrix(self, origins, destinations, mode='driving', **kwargs):
+        response = self.client.distance_matrix(origins, destinations, mode=mode, **kwargs)
+        return self.record('distance_matrix', response, origins=[list(map(float, origin)) for origin in origins],
+                           destinations=[list(map(float, destination)) for destination in destinations], mode=mode)
+
+class ReplayClient(SyntheticClient):
+    '''
+    Answers with the responses of a file written by RecordingClient. A request recorded several times
+    gets the recorded responses in order (the last one repeats), a request that wasn't recorded fails with NOT_FOUND.
+    '''
+
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        self.recorded = {}
+        with open(path) as file:
+            for line in file:
+                entry = json.loads(line)
+                self.recorded.setdefault(entry['key'], []).append(entry['response'])
+        self.replayed = {}
+
+    def request(self, method, respond, **args):
+        key = request_key(method, **args)
+
+        def replay():
+            responses = self.recorded.get(key)
+            if not responses:
+                raise googlemaps.exceptions.ApiError('NOT_FOUND', f"{method} wasn't recorded")
+            with self.lock:
+                index = self.replayed.get(key, 0)
+                self.replayed[key] = index + 1
+            return responses[min(index, len(responses) - 1)]
+
+        return super().request(method, replay, **args)
+
+def make_client(name=None):
+    '''
+    Returns the client named by MAPS_CLIENT (or name):
+    'google' (default), 'synthetic', 'replay:<file>' or 'record:<file>' (the Google client, recorded).
+    Stand-ins read their latency, jitter, error rate and seed from MAPS_LATENCY, MAPS_JITTER, MAPS_ERROR_RATE and MAPS_SEED.
+    '''
+    name = name or os.getenv('MAPS_CLIENT', 'google')
+    kind, _, path = name.partition(':')
+    stand_in = {
+        'latency': float(os.getenv('MAPS_LATENCY', 0)),
+        'jitter': float(os.getenv('MAPS_JITTER', 0)),
+        'error_rate': float(os.getenv('MAPS_ERROR_RATE', 0)),
+        'seed': int(os.getenv('MAPS_SEED', 0)),
+    }
+
+    if kind == 'synthetic':
+        return SyntheticClient(**stand_in)
+    if kind == 'replay':
+        return ReplayClient(path, **stand_in)
+
+    client = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
+    if kind == 'record':
+        return RecordingClient(client, path)
+    if kind != 'google':
+        raise ValueError(f"Unknown MAPS_CLIENT {name}")
+    return client
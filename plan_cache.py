@@ -0,0 +1,126 @@
+"""
+Cache of router() results
+
+Plans are keyed by a hash of the router inputs and kept in a bounded in-memory LRU
+with a time to live. If a database path is given they are also saved in a
+plan_cache table so they survive restarts.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from db import get_connection
+
+def plan_key(required, optional, ranking_considered, transport_mode, days_traveled):
+    '''
+    Returns a canonical hash of the inputs of router()
+    '''
+    inputs = [required, optional, bool(ranking_considered), transport_mode, int(days_traveled)]
+    return hashlib.sha256(json.dumps(inputs, separators=(',', ':')).encode()).hexdigest()
+
+class PlanCache:
+    '''
+    LRU cache of plans with a time to live (in seconds) and optional SQLite persistence
+    '''
+
+    def __init__(self, max_size=128, ttl=3600, db_path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_path = db_path
+        self.plans = OrderedDict() # key -> (created_at, plan)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if db_path:
+            conn = get_connection(db_path)
+            conn.execute("CREATE TABLE IF NOT EXISTS plan_cache (key TEXT PRIMARY KEY, plan TEXT, created_at REAL)")
+            conn.commit()
+
+    def get(self, key, count=True):
+        '''
+        Returns the cached plan for the key, or None if it is missing or expired
+        Lookups with count=False don't change the hit/miss counters
+        '''
+        now = time.time()
+        with self.lock:
+            entry = self.plans.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self.plans.move_to_end(key)
+                self.hits += count
+                return entry[1]
+            self.plans.pop(key, None)
+
+        entry = self._load(key)
+        with self.lock:
+            if entry and now - entry[0] < self.ttl:
+                self._remember(key, *entry)
+                self.hits += count
+                return entry[1]
+            self.misses += count
+        return None
+
+    def put(self, key, plan):
+        '''
+        Caches a plan, evicting the least recently used one if the cache is full
+        '''
+        created_at = time.time()
+        with self.lock:
+            self._remember(key, created_at, plan)
+        self._save(key, created_at, plan)
+
+    def get_or_compute(self, router, required, optional, ranking_considered, transport_mode, days_traveled, previous_key=None):
+        '''
+        Returns the key and the cached plan for these router inputs, calling router on a miss
+        On a miss router starts from the plan of previous_key (e.g. the last plan of the user) if it is still cached
+        A plan that visits no place (e.g. no solution was found in time) isn't cached, the next request solves again
+        '''
+        key = plan_key(required, optional, ranking_considered, transport_mode, days_traveled)
+        plan = self.get(key)
+        if plan is None:
+            previous = self.get(previous_key, count=False) if previous_key else None
+            router_kwargs = {'previous_plan': previous[0]} if previous and previous[0] else {}
+            plan = router(required, optional, ranking_considered, transport_mode, days_traveled, **router_kwargs)
+            routes, _, _, num_sites = plan
+            if routes and num_sites:
+                self.put(key, plan)
+        return key, plan
+
+    def stats(self):
+        '''
+        Returns the hit/miss counters and the number of plans in memory
+        '''
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self.plans)}
+
+    def _remember(self, key, created_at, plan):
+        self.plans[key] = (created_at, plan)
+        self.plans.move_to_end(key)
+        while len(self.plans) > self.max_size:
+            self.plans.popitem(last=False)
+
+    def _load(self, key):
+        if not self.db_path:
+            return None
+
+        conn = get_connection(self.db_path)
+        row = conn.execute("SELECT created_at, plan FROM plan_cache WHERE key = ?", (key,)).fetchone()
+        if row and time.time() - row[0] >= self.ttl:
+            conn.execute("DELETE FROM plan_cache WHERE key = ?", (key,))
+            conn.commit()
+            row = None
+
+        if row is None:
+            return None
+        # JSON turns the returned tuple into a list
+        return row[0], tuple(json.loads(row[1]))
+
+    def _save(self, key, created_at, plan):
+        if not self.db_path:
+            return
+
+        conn = get_connection(self.db_path)
+        conn.execute("INSERT OR REPLACE INTO plan_cache (key, plan, created_at) VALUES (?, ?, ?)", (key, json.dumps(plan), created_at))
+        conn.commit()
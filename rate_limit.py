@@ -0,0 +1,57 @@
+"""
+Rate limiting and retries for the Google Maps requests
+
+A token bucket shared by the scraping threads keeps the request rate under the API quota,
+and failed requests are retried with exponential backoff (with jitter so threads that failed
+together don't retry together).
+"""
+
+import random
+import threading
+import time
+
+class TokenBucket:
+    '''
+    Allows rate requests per second on average and bursts of up to capacity requests
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        '''
+        Waits until the tokens are available and takes them
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+def call_with_retries(func, *args, retries=3, backoff=0.5, max_backoff=8, should_retry=None, bucket=None, **kwargs):
+    '''
+    Calls func(*args, **kwargs), taking a token from the bucket before every attempt.
+    Errors accepted by should_retry (all of them by default) are retried up to retries times,
+    waiting backoff, 2 * backoff, 4 * backoff... (at most max_backoff) seconds in between.
+    '''
+    for attempt in range(retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries or (should_retry is not None and not should_retry(e)):
+                raise
+            time.sleep(min(max_backoff, backoff * 2 ** attempt) * random.uniform(0.5, 1))
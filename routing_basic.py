@@ -5,12 +5,13 @@ If there is no solution involving every one of the nodes, the algorithm will ret
 """
 
 import sqlite3
-import math
+import time
+import numpy as np
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
 from data_scraper import * 
+from distances import haversine_matrix
 
-EARTH_R_METERS = 6371e3 
 TRANSPORT_SPEEDS = {
     "car": 0.002, # 20 mph
     "walking": 0.012, # 5km/h
@@ -25,47 +26,77 @@ TRANSPORT_DAILY_LOC_LIMITS = {
     'bike' : 15,
 }
 
-def compute_distance_matrix(locations):
+# Mode names used by the Distance Matrix API, also used as keys of the travel_times cache
+GOOGLE_TRAVEL_MODES = {
+    "car": "driving",
+    "walking": "walking",
+    'public transport' : "transit",
+    'bike' : "bicycling",
+}
+
+# How long the solver is allowed to search: base + per node + per day, capped at max_seconds.
+# The search also stops once the objective hasn't improved for plateau_seconds.
+SOLVE_BUDGET = {
+    'base_seconds': 1,
+    'seconds_per_node': 0.1,
+    'seconds_per_day': 0.5,
+    'max_seconds': 20,
+    'plateau_seconds': 2,
+    'warm_plateau_seconds': 0.5,    # a search started from the previous plan is already close to its optimum
+}
+
+# Largest penalty for dropping a place, keeps compounded ranking penalties within int64
+MAX_PENALTY = 2**50
+
+# (first solution strategy, local search metaheuristic) used by default
+DEFAULT_STRATEGY = ('PATH_CHEAPEST_ARC', 'GUIDED_LOCAL_SEARCH')
+
+ROUTING_STATUSES = {getattr(pywrapcp.RoutingModel, name): name for name in dir(pywrapcp.RoutingModel) if name.startswith('ROUTING_')}
+
+def compute_distance_matrix(locations, chunk_rows=None):
     """
     Creates a distance matrix using Haversine distance between longitudes
     and latitudes.
+
+    Returns a square integer numpy array (meters) computed in one batch,
+    or chunk_rows rows at a time for very large numbers of locations.
     """
-    
-    distance_matrix = []
-
-    for from_i, from_node in enumerate(locations):
-        individual_node_distances = []
-        for to_i, to_node in enumerate(locations):
-            if from_i == to_i:
-                individual_node_distances.append(0)
-            else:
-                # Use Haversine formula to compute the shortest distance over the earth’s surface between locations
-                lat1, lon1 = to_node
-                lat2, lon2 = from_node
-
-                phi1 = lat1 * math.pi / 180  # phi, lambda in radians
-                phi2 = lat2 * math.pi / 180
-                phi_diff = (lat2 - lat1) * math.pi / 180 # latitude diff
-                lambda_diff = (lon2 - lon1) * math.pi / 180 # longitude diff
-
-                a = math.sin(phi_diff / 2) * math.sin(phi_diff / 2) + math.cos(phi1) * math.cos(phi2) * math.sin(lambda_diff / 2) * math.sin(lambda_diff / 2)
-                c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-                distance = int(EARTH_R_METERS * c)  # distance in meters
-                individual_node_distances.append(distance)
-        distance_matrix.append(individual_node_distances)
-    return distance_matrix
+    return haversine_matrix(locations, chunk_rows)
 
 def compute_time_matrix(transport_mode, distance_matrix):
     """
     Creates a time matrix using the distance matrix found previously and 
     the average times for different modes of transports we support.
 
-    Returns square list of lists with dimensions equal to the number of nodes,
+    Returns square integer numpy array with dimensions equal to the number of nodes,
     such that entry (i,j) is the time it takes to get from node i to node j
     """
-    assert(transport_mode in TRANSPORT_SPEEDS, f"You are providing an invalid transport method {transport_mode}")
-    return [[int(TRANSPORT_SPEEDS[transport_mode]*length) for length in distance] for distance in distance_matrix]
+    assert transport_mode in TRANSPORT_SPEEDS, f"You are providing an invalid transport method {transport_mode}"
+    return (np.asarray(distance_matrix) * TRANSPORT_SPEEDS[transport_mode]).astype(np.int32)
+
+def compute_travel_matrices(place_ids, locations, transport_mode):
+    """
+    Creates the distance (meters) and time (minutes) matrices between the locations.
+
+    Every pair is computed in memory with Haversine. With GOOGLE_TRAVEL_TIMES, the travel times
+    of the Distance Matrix API (see fetch_travel_times) replace the estimates of the pairs that have a route.
+    """
+    distance_matrix = compute_distance_matrix(locations)
+    time_matrix = compute_time_matrix(transport_mode, distance_matrix)
+    if not GOOGLE_TRAVEL_TIMES:
+        return distance_matrix, time_matrix
+
+    # The hotel has no place id so it never has Google travel times
+    node_of_place = {place_id: i for i, place_id in enumerate(place_ids) if place_id != 'HOTEL'}
+    google_times = fetch_travel_times(list(node_of_place), GOOGLE_TRAVEL_MODES[transport_mode])
+    for (place_a, place_b), (meters, seconds) in google_times.items():
+        if meters is None or seconds is None:
+            continue
+        from_i, to_i = node_of_place[place_a], node_of_place[place_b]
+        distance_matrix[from_i, to_i] = meters
+        time_matrix[from_i, to_i] = seconds // 60
+
+    return distance_matrix, time_matrix
 
 def print_solution(data, manager, routing, solution):
     '''
@@ -142,32 +173,166 @@ def return_solution(data, manager, routing, solution, reference_list):
 
     return plan, total_travel_time, total_visit_time, len(sites)-1
 
+def solve_time_limit(num_nodes, num_days, budget=SOLVE_BUDGET):
+    """
+    Returns the number of seconds the solver can search for a trip of this size
+    """
+    seconds = budget['base_seconds'] + budget['seconds_per_node'] * num_nodes + budget['seconds_per_day'] * num_days
+    return min(seconds, budget['max_seconds'])
 
-def create_time_callback(manager, time_matrix):
-    def time_callback(from_i, to_i):
-        """Returns the travel time between the two nodes (set to minutes)."""
-        # Convert from routing variable Index to time matrix NodeIndex.
-        from_node = manager.IndexToNode(from_i)
-        to_node = manager.IndexToNode(to_i)
-        return time_matrix[from_node][to_node] 
-    return time_callback
+class PlateauMonitor:
+    """
+    Solution callback that stops the search once the objective
+    hasn't improved for plateau_seconds
+    """
+    def __init__(self, routing, plateau_seconds):
+        self.routing = routing
+        self.plateau_seconds = plateau_seconds
+        self.start = time.monotonic()
+        self.last_improvement = self.start
+        self.best_objective = None
+        self.num_solutions = 0
+        self.plateaued = False
+
+    def __call__(self):
+        now = time.monotonic()
+        objective = self.routing.CostVar().Value()
+        self.num_solutions += 1
+
+        if self.best_objective is None or objective < self.best_objective:
+            self.best_objective = objective
+            self.last_improvement = now
+        elif now - self.last_improvement >= self.plateau_seconds:
+            self.plateaued = True
+            self.routing.solver().FinishCurrentSearch()
+
+    def restart(self, plateau_seconds):
+        """
+        Starts watching a new search, keeping the overall start time and solution count
+        """
+        self.plateau_seconds = plateau_seconds
+        self.last_improvement = time.monotonic()
+        self.best_objective = None
+        self.plateaued = False
+
+def stop_reason(monitor, solution, time_limit):
+    """
+    Returns why the search stopped: plateau, time_limit, completed or no_solution
+    """
+    if solution is None:
+        return 'no_solution'
+    if monitor.plateaued:
+        return 'plateau'
+    if time.monotonic() - monitor.start >= time_limit:
+        return 'time_limit'
+    return 'completed'
+
+def warm_start_routes(previous_plan, reference_list, manager, routing, time_matrix):
+    """
+    Converts a plan returned by return_solution into routes of node indices
+    for the current locations, to be used as the initial solution.
 
-def router(required, optional, ranking_considered, transport_mode, days_traveled):
+    Places that are no longer part of the trip are dropped. Places that can't be
+    dropped (no disjunction) and are missing from the plan are inserted where they
+    add the least travel time. Other new places are left for the solver to insert.
+    """
+    node_of_place = {(ref['name'], ref['lat'], ref['long']): i for i, ref in enumerate(reference_list)}
+    num_days = manager.GetNumberOfVehicles()
+
+    routes = []
+    planned = set()
+    for day_plan in previous_plan[:num_days]:
+        route = []
+        for place in day_plan[1:-1]: # skips the hotel at the start and end of the day
+            node = node_of_place.get((place['name'], place['lat'], place['long']))
+            if node and node not in planned:
+                route.append(node)
+                planned.add(node)
+        routes.append(route)
+    routes += [[] for _ in range(num_days - len(routes))]
+
+    for node in range(1, len(reference_list)):
+        if node in planned or routing.GetDisjunctionIndices(manager.NodeToIndex(node)):
+            continue
+
+        # Cheapest insertion over every day and position, the hotel being node 0
+        best = None
+        for day, route in enumerate(routes):
+            stops = [0] + route + [0]
+            for position in range(len(stops) - 1):
+                before, after = stops[position], stops[position + 1]
+                added_time = time_matrix[before, node] + time_matrix[node, after] - time_matrix[before, after]
+                if best is None or added_time < best[0]:
+                    best = (added_time, day, position)
+        routes[best[1]].insert(best[2], node)
+        planned.add(node)
+
+    return routes
+
+def cluster_by_day(hotel, places, num_days, num_required):
+    """
+    Groups places into num_days geographic clusters around the hotel (cluster-first, route-second).
+
+    Places are swept by their angle around the hotel, starting after the widest empty angle,
+    and the sweep is cut into num_days consecutive sectors. The first num_required places
+    are required: they are spread evenly between the days first, then the others are.
+
+    Returns one sorted array of indices into places per day.
+    """
+    if not places:
+        return [np.array([], dtype=int) for _ in range(num_days)]
+
+    coords = np.array([(latitude, longitude) for _, _, latitude, longitude, _, _, _ in places], dtype=np.float64)
+    hotel_latitude, hotel_longitude = hotel[2], hotel[3]
+    north = coords[:, 0] - hotel_latitude
+    east = (coords[:, 1] - hotel_longitude) * np.cos(np.radians(hotel_latitude))
+    angles = np.arctan2(north, east)
+
+    # Start the sweep after the largest gap so no sector wraps around a dense area
+    order = np.argsort(angles, kind='stable')
+    sorted_angles = angles[order]
+    gaps = np.diff(np.append(sorted_angles, sorted_angles[0] + 2 * np.pi))
+    order = np.roll(order, -(int(np.argmax(gaps)) + 1))
+
+    # A required place outweighs all optional ones, so cuts balance required places first
+    weights = np.where(order < num_required, len(places), 1)
+    cumulative = np.cumsum(weights)
+    cuts = np.searchsorted(cumulative, [cumulative[-1] * day / num_days for day in range(1, num_days)], side='right')
+
+    return [np.sort(cluster) for cluster in np.split(order, cuts)]
+
+def router(required, optional, ranking_considered, transport_mode, days_traveled, budget=SOLVE_BUDGET, solve_stats=None, previous_plan=None, strategy=DEFAULT_STRATEGY, time_matrix=None, truncate=True):
     """
     Finds the optimal route between the given required and optional locations given a ranking,
     transportation mode, and number of days (number of vehicles)
+
+    The search time follows the budget (see SOLVE_BUDGET). If a solve_stats dict is given,
+    it is filled with the time limit, solve time, objective and the reason the search stopped.
+
+    If previous_plan (the plan returned by an earlier call) is given, the search starts from it
+    instead of from scratch, which converges much faster when only a few inputs changed: it stops after
+    warm_plateau_seconds without improvement. A search from scratch only runs if the previous plan can't be used.
+
+    strategy is a pair of names of a FirstSolutionStrategy and a LocalSearchMetaheuristic.
+
+    time_matrix can be given to reuse a time matrix (minutes) already computed for required + optional
+    for this transport mode, instead of building one.
+
+    With truncate=False every optional location is kept even beyond TRANSPORT_DAILY_LOC_LIMITS.
     """
 
+    place_ids = []
     locations_for_distance_matrix = []
     time_windows = []
     reference_list = []
     
     locations = required + optional # all locations
     total_num_locations = len(locations)
+    num_candidates = total_num_locations
     num_loc_per_day = total_num_locations / days_traveled
 
     # Truncates locations if it seems excessive per day
-    if num_loc_per_day > TRANSPORT_DAILY_LOC_LIMITS[transport_mode]:
+    if truncate and num_loc_per_day > TRANSPORT_DAILY_LOC_LIMITS[transport_mode]:
         dif = num_loc_per_day - TRANSPORT_DAILY_LOC_LIMITS[transport_mode]
         num_locs_dif = round(dif * days_traveled)
         total_num_locations -= num_locs_dif
@@ -179,16 +344,21 @@ def router(required, optional, ranking_considered, transport_mode, days_traveled
     else:
         optional = locations[len(required):]
 
-    for _, name, latitude, longitude, open_time, close_time, visit_time in locations:
+    for place_id, name, latitude, longitude, open_time, close_time, visit_time in locations:
+        place_ids.append(place_id)
         locations_for_distance_matrix.append((latitude, longitude))
         time_windows.append((open_time, close_time))
-        reference_list.append({'name':name, 'lat':latitude, 'long':longitude, 'visit_time':visit_time})
+        reference_list.append({'name':name, 'lat':latitude, 'long':longitude, 'visit_time':int(visit_time)}) # durations must be integers
 
-    distance_matrix = compute_distance_matrix(locations_for_distance_matrix)
+    if time_matrix is None:
+        distance_matrix, time_matrix = compute_travel_matrices(place_ids, locations_for_distance_matrix, transport_mode)
+    else:
+        # Locations are only ever truncated at the end, so the matrix is the top left corner
+        time_matrix = np.asarray(time_matrix)[:len(locations), :len(locations)]
 
     """Solve the VRP with time windows."""
     data = {
-        "time_matrix": compute_time_matrix(transport_mode, distance_matrix),
+        "time_matrix": time_matrix,
         "time_windows": time_windows,
         "num_days": days_traveled,
         "depot": 0, # start and end point's index (hotel)
@@ -202,8 +372,8 @@ def router(required, optional, ranking_considered, transport_mode, days_traveled
     # Create Routing Model
     routing = pywrapcp.RoutingModel(manager)
 
-    time_callback = create_time_callback(manager, data["time_matrix"])
-    transit_callback_index = routing.RegisterTransitCallback(time_callback)
+    # Register the matrix natively so the search never calls back into Python
+    transit_callback_index = routing.RegisterTransitMatrix(data["time_matrix"].tolist())
 
     # Define cost of each arc
     routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
@@ -248,25 +418,22 @@ def router(required, optional, ranking_considered, transport_mode, days_traveled
             node_visit_transit)
 
     if optional:
-        total_travel_time_minus_depot = 0
-        for node_distances in data["time_matrix"][1:]: # skips hotel
-            total_travel_time_minus_depot += (sum(node_distances) - node_distances[0]) # skips hotel
-
-        total_travel_time_minus_depot = int(total_travel_time_minus_depot/2)
+        # Sum of all travel times not going to or from the hotel
+        total_travel_time_minus_depot = int(data["time_matrix"][1:, 1:].sum() / 2)
 
         penalty = total_travel_time_minus_depot
 
         if ranking_considered:
             percent_penalty = 0
-            for node_idx in range(len(locations),0,-1):
+            for node_idx in range(len(locations)-1,0,-1):
                 # add penalty that is 5% larger for each higher ranking
-                penalty = penalty*(1+percent_penalty)
-                routing.AddDisjunction([manager.NodeToIndex(node_idx)], penalty)
+                penalty = min(penalty*(1+percent_penalty), MAX_PENALTY)
+                routing.AddDisjunction([manager.NodeToIndex(node_idx)], int(penalty))
                 percent_penalty += 0.05
 
         else:
             # Allow node dropping for locations that are optional - set penalty to be greater than sum of all distances not going to depot
-            for node_idx in range(len(optional)-1, len(locations)):
+            for node_idx in range(len(required), len(locations)):
                 routing.AddDisjunction([manager.NodeToIndex(node_idx)], penalty)
 
     # Instantiate route start and end times to produce feasible times
@@ -277,13 +444,58 @@ def router(required, optional, ranking_considered, transport_mode, days_traveled
         routing.AddVariableMinimizedByFinalizer(time_dimension.CumulVar(routing.End(i)))
 
     # Setting first solution heuristic
+    first_solution_strategy, local_search_metaheuristic = strategy
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
-    search_parameters.time_limit.seconds = 20
-    search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
-
-    # Solve the problem
-    solution = routing.SolveWithParameters(search_parameters)
+    search_parameters.local_search_metaheuristic = getattr(routing_enums_pb2.LocalSearchMetaheuristic, local_search_metaheuristic)
+    search_parameters.first_solution_strategy = getattr(routing_enums_pb2.FirstSolutionStrategy, first_solution_strategy)
+
+    # Scale the search time with the size of the trip and stop early on a plateau
+    time_limit = solve_time_limit(len(locations), days_traveled, budget)
+    search_parameters.time_limit.FromMilliseconds(int(time_limit * 1000))
+    monitor = PlateauMonitor(routing, budget['plateau_seconds'])
+    routing.AddAtSolutionCallback(monitor)
+
+    # Solve the problem, starting from the previous plan if there is one
+    solution = None
+    warm_started = False
+    if previous_plan:
+        routes = warm_start_routes(previous_plan, reference_list, manager, routing, data["time_matrix"])
+        # Reading routes closes the model, with the default parameters (no metaheuristic) unless it is already closed
+        routing.CloseModelWithParameters(search_parameters)
+        initial_solution = routing.ReadAssignmentFromRoutes(routes, True)
+        if initial_solution:
+            # It starts close to its optimum, so it gives up sooner than a search from scratch
+            monitor.plateau_seconds = budget['warm_plateau_seconds']
+            solution = routing.SolveFromAssignmentWithParameters(initial_solution, search_parameters)
+            warm_started = solution is not None
+
+    if solution is None:
+        monitor.restart(budget['plateau_seconds'])
+        solution = routing.SolveWithParameters(search_parameters)
+
+    dropped = []
+    if solution:
+        for node in range(1, len(reference_list)):
+            index = manager.NodeToIndex(node)
+            if solution.Value(routing.NextVar(index)) == index:
+                dropped.append(reference_list[node]['name'])
+
+    stats = {
+        'num_nodes': len(locations),
+        'num_truncated': num_candidates - len(locations),
+        'dropped_nodes': dropped,
+        'time_limit': time_limit,
+        'solve_seconds': time.monotonic() - monitor.start,
+        'num_solutions': monitor.num_solutions,
+        'objective': solution.ObjectiveValue() if solution else None,
+        'stop_reason': stop_reason(monitor, solution, time_limit),
+        'status': ROUTING_STATUSES.get(routing.status()),
+        'warm_started': warm_started,
+        'strategy': tuple(strategy),
+    }
+    print(f"Search stopped ({stats['stop_reason']}) after {stats['solve_seconds']:.2f}s of {time_limit:.2f}s")
+    if solve_stats is not None:
+        solve_stats.update(stats)
     
     # Print solution on console.
     if solution:
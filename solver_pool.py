@@ -0,0 +1,301 @@
+"""
+Runs router() in a pool of worker processes
+
+The web process only builds the inputs and renders the output, the OR-Tools search
+happens in the workers. Each worker process is fed one job at a time by its own thread,
+so a job that has to be abandoned (timeout or cancel) only kills the process running it,
+the other jobs keep running. Workers are started on demand and replaced after a number of jobs.
+
+In portfolio mode the same trip is solved with several strategies at once and the best plan wins.
+In clustered mode the places are split into one geographic cluster per day and the days are solved in parallel.
+"""
+
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import threading
+from concurrent.futures import Future, wait, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from routing_basic import router, cluster_by_day, SOLVE_BUDGET
+
+# (first solution strategy, local search metaheuristic) pairs raced by solve_portfolio
+PORTFOLIO = [
+    ('PATH_CHEAPEST_ARC', 'GUIDED_LOCAL_SEARCH'),
+    ('PARALLEL_CHEAPEST_INSERTION', 'GUIDED_LOCAL_SEARCH'),
+    ('SAVINGS', 'SIMULATED_ANNEALING'),
+    ('LOCAL_CHEAPEST_INSERTION', 'TABU_SEARCH'),
+]
+
+# Insertion heuristics find first solutions quickly when most places can be dropped,
+# which is the case for the large single day problems of solve_clustered
+CLUSTER_STRATEGY = ('PARALLEL_CHEAPEST_INSERTION', 'GUIDED_LOCAL_SEARCH')
+
+class SolverTimeout(Exception):
+    '''
+    Raised when a job doesn't finish within its timeout
+    '''
+
+def run_router(args, kwargs):
+    '''
+    Returns the router() output and its solve stats
+    '''
+    solve_stats = {}
+    return router(*args, solve_stats=solve_stats, **kwargs), solve_stats
+
+def worker_main(conn):
+    '''
+    Entry point of the worker processes, solves the (args, kwargs) jobs received on conn until it gets None
+    '''
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+
+        try:
+            outcome = (True, run_router(*job))
+        except Exception as e:
+            outcome = (False, e)
+
+        try:
+            conn.send(outcome)
+        except Exception as e: # the error can't be pickled
+            conn.send((False, RuntimeError(repr(e))))
+
+class SolverExecutor:
+    '''
+    Pool of worker processes that solve router() jobs
+    '''
+
+    def __init__(self, max_workers=None, timeout=60, max_jobs_per_worker=50):
+        self.max_workers = max_workers or os.cpu_count()
+        self.timeout = timeout
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.jobs = queue.Queue()   # (future, args, kwargs) waiting for a worker, None stops a worker
+        self.abandoned = set()      # futures of running jobs whose worker has to be killed
+        self.lock = threading.Lock()
+
+        # Spawned workers don't inherit the web server's threads and sockets
+        self.context = multiprocessing.get_context('spawn')
+        self.threads = [threading.Thread(target=self._feed_worker, daemon=True) for _ in range(self.max_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _start_process(self):
+        conn, worker_conn = self.context.Pipe()
+        process = self.context.Process(target=worker_main, args=(worker_conn,), daemon=True)
+        process.start()
+        worker_conn.close()
+        return process, conn
+
+    def _stop_process(self, process, conn, kill=False):
+        if process is None:
+            return
+        if kill:
+            process.terminate()
+        else:
+            try:
+                conn.send(None)
+            except OSError:
+                process.terminate()
+        process.join()
+        conn.close()
+
+    def _feed_worker(self):
+        # Sends the queued jobs one at a time to a worker process, starting it when needed
+        process, conn, num_jobs = None, None, 0
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                self._stop_process(process, conn)
+                return
+
+            future, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            if process is None or num_jobs >= self.max_jobs_per_worker:
+                self._stop_process(process, conn)
+                process, conn = self._start_process()
+                num_jobs = 0
+            num_jobs += 1
+
+            try:
+                conn.send((args, kwargs))
+                while not multiprocessing.connection.wait([conn, process.sentinel], timeout=0.1):
+                    if future in self.abandoned:
+                        break
+
+                if future in self.abandoned:
+                    self._stop_process(process, conn, kill=True)
+                    process = None
+                    future.set_exception(SolverTimeout("The job was abandoned"))
+                else:
+                    succeeded, outcome = conn.recv()
+                    if succeeded:
+                        future.set_result(outcome)
+                    else:
+                        future.set_exception(outcome)
+            except (EOFError, OSError):
+                # The worker died (e.g. killed by the system), the next job starts a new one
+                self._stop_process(process, conn, kill=True)
+                process = None
+                future.set_exception(BrokenProcessPool("The solver worker running the job died"))
+            finally:
+                with self.lock:
+                    self.abandoned.discard(future)
+
+    def submit(self, required, optional, ranking_considered, transport_mode, days_traveled, timeout=None, **router_kwargs):
+        '''
+        Queues a router() job and returns its future, whose result is (router output, solve stats).
+        The solver budget is capped so the search ends before the timeout.
+        '''
+        timeout = timeout or self.timeout
+        if 'budget' not in router_kwargs:
+            router_kwargs['budget'] = dict(SOLVE_BUDGET, max_seconds=min(SOLVE_BUDGET['max_seconds'], timeout * 0.8))
+
+        args = (required, optional, ranking_considered, transport_mode, days_traveled)
+        future = Future()
+        self.jobs.put((future, args, router_kwargs))
+        return future
+
+    def solve(self, required, optional, ranking_considered, transport_mode, days_traveled, timeout=None, solve_stats=None, **router_kwargs):
+        '''
+        Same as router() but runs in a worker, raises SolverTimeout if it takes longer than timeout seconds
+        '''
+        timeout = timeout or self.timeout
+        for attempt in range(2):
+            job = self.submit(required, optional, ranking_considered, transport_mode, days_traveled, timeout, **router_kwargs)
+            try:
+                output, stats = job.result(timeout=timeout)
+                break
+            except FutureTimeoutError:
+                self.cancel(job)
+                raise SolverTimeout(f"Solver didn't finish within {timeout}s")
+            except BrokenProcessPool:
+                # Its worker died, the job is solved again by a new one
+                if attempt:
+                    raise
+
+        if solve_stats is not None:
+            solve_stats.update(stats)
+        return output
+
+    def solve_portfolio(self, required, optional, ranking_considered, transport_mode, days_traveled, timeout=None, solve_stats=None, strategies=PORTFOLIO, **router_kwargs):
+        '''
+        Solves the trip with every strategy in parallel and returns the plan with the best objective.
+        Strategies still running when the timeout expires are cancelled.
+        solve_stats gets the stats of the winner and the objective of every strategy under 'portfolio'.
+        '''
+        timeout = timeout or self.timeout
+        jobs = {self.submit(required, optional, ranking_considered, transport_mode, days_traveled, timeout, strategy=strategy, **router_kwargs): strategy
+                for strategy in strategies}
+
+        done, not_done = wait(jobs, timeout=timeout)
+        self.cancel(*not_done)
+
+        best = None
+        portfolio = []
+        for job in done:
+            if job.exception() is not None:
+                continue
+            output, stats = job.result()
+            portfolio.append({'strategy': jobs[job], 'objective': stats['objective'], 'solve_seconds': stats['solve_seconds']})
+            if stats['objective'] is not None and (best is None or stats['objective'] < best[1]['objective']):
+                best = (output, stats)
+
+        if best is None:
+            if not_done:
+                raise SolverTimeout(f"No strategy found a solution within {timeout}s")
+            return [], 0, 0, 0
+
+        output, stats = best
+        print(f"Portfolio winner: {stats['strategy']} with objective {stats['objective']} ({len(portfolio)}/{len(jobs)} strategies finished)")
+        if solve_stats is not None:
+            solve_stats.update(stats, portfolio=portfolio)
+        return output
+
+    def solve_clustered(self, required, optional, ranking_considered, transport_mode, days_traveled, timeout=None, solve_stats=None, **router_kwargs):
+        '''
+        Splits the places into one cluster per day around the hotel (see cluster_by_day) and solves
+        each day as its own single day trip in parallel, without truncating the optional places.
+        A day that can't be solved in time stays at the hotel.
+        '''
+        timeout = timeout or self.timeout
+        hotel = required[0]
+        places = required[1:] + optional
+        num_required = len(required) - 1
+        router_kwargs.setdefault('strategy', CLUSTER_STRATEGY)
+
+        # Each day is a single day trip, it starts from the stops of the previous plan that fell in its cluster
+        previous_plan = router_kwargs.pop('previous_plan', None)
+        if previous_plan:
+            stops = [stop for day_plan in previous_plan for stop in day_plan[1:-1]]
+            router_kwargs['previous_plan'] = [[previous_plan[0][0]] + stops + [previous_plan[0][-1]]]
+
+        jobs = []
+        for cluster in cluster_by_day(hotel, places, days_traveled, num_required):
+            day_required = [hotel] + [places[i] for i in cluster if i < num_required]
+            day_optional = [places[i] for i in cluster if i >= num_required]
+            jobs.append(self.submit(day_required, day_optional, ranking_considered, transport_mode, 1, timeout, truncate=False, **router_kwargs))
+
+        done, not_done = wait(jobs, timeout=timeout)
+        self.cancel(*not_done)
+
+        plan = []
+        total_travel_time, total_visit_time, num_sites = 0, 0, 0
+        days_stats = []
+        for job in jobs:
+            if job in done and job.exception() is None and job.result()[0][0]:
+                (day_plan, travel_time, visit_time, day_sites), stats = job.result()
+                plan += day_plan
+                total_travel_time += travel_time
+                total_visit_time += visit_time
+                num_sites += day_sites
+                days_stats.append(stats)
+            else:
+                hotel_stop = {'name': hotel[1], 'lat': hotel[2], 'long': hotel[3], 'travel_time': hotel[4], 'visit_time': 0}
+                plan.append([hotel_stop, dict(hotel_stop)])
+                days_stats.append(None)
+
+        if solve_stats is not None:
+            solved = [stats for stats in days_stats if stats]
+            solve_stats.update(
+                objective=sum(stats['objective'] for stats in solved),
+                dropped_nodes=[name for stats in solved for name in stats['dropped_nodes']],
+                solve_seconds=max([stats['solve_seconds'] for stats in solved], default=0),
+                stop_reason='clustered',
+                days=days_stats,
+            )
+        return plan, total_travel_time, total_visit_time, num_sites
+
+    def cancel(self, *jobs):
+        '''
+        Cancels jobs. Jobs that are already running can't be interrupted,
+        so the worker processes running them are killed (and started again for the next jobs).
+        '''
+        for job in jobs:
+            if not job.cancel() and not job.done():
+                with self.lock:
+                    self.abandoned.add(job)
+
+    def shutdown(self, wait=True):
+        '''
+        Stops the workers, cancelling the jobs that haven't started
+        '''
+        while True:
+            try:
+                item = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[0].cancel()
+
+        for _ in self.threads:
+            self.jobs.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
@@ -0,0 +1,66 @@
+import importlib.util
+import os
+import shutil
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('MAPS_CLIENT', 'synthetic') # no Google API key needed
+
+from db import migrate_database
+
+@pytest.fixture(scope='session', autouse=True)
+def travel_db(tmp_path_factory):
+    '''
+    Runs the tests on a migrated copy of Databases/travel.db (the code opens it relative to the working directory)
+    '''
+    directory = tmp_path_factory.mktemp('travel')
+    shutil.copytree(os.path.join(ROOT, 'Databases'), directory / 'Databases', ignore=shutil.ignore_patterns('*.db-wal', '*.db-shm', '__pycache__'))
+
+    migrate_database(str(directory / 'Databases' / 'travel.db'))
+    cwd = os.getcwd()
+    os.chdir(directory)
+    yield directory / 'Databases' / 'travel.db'
+    os.chdir(cwd)
+
+@pytest.fixture(scope='session')
+def hotel():
+    '''
+    Hotel of a trip in Dubai, where the places of Databases/travel.db are (awake 8AM to midnight)
+    '''
+    return ('HOTEL', 'Hotel', 25.2048, 55.2708, 480, 1440, 0)
+
+@pytest.fixture(scope='session')
+def trip_places(travel_db):
+    '''
+    Returns a function returning the candidates of a trip as get_routes_simple returns them
+    (every place of the database, awake 8AM to midnight), read again on every call
+    '''
+    from data_scraper import get_connection, get_routes_simple
+
+    def trip_places():
+        place_ids = [row[0] for row in get_connection().execute("SELECT place_id FROM places ORDER BY id")]
+        return get_routes_simple(place_ids, 1440, 480, [], [], 3)
+    return trip_places
+
+@pytest.fixture(scope='session')
+def new_place():
+    '''
+    Returns a function building the cleaned details (see clean_data) of a place in Dubai, as insert_places_batch takes them
+    '''
+    def new_place(place_id, types):
+        formatted_details = {'name': place_id, 'lat': 25.2, 'lng': 55.27, 'types': ', '.join(types), 'place_id': place_id, 'price_level': 1}
+        return [formatted_details, [], [[place_id, None, None, None]], [[place_id, set(types)]]]
+    return new_place
+
+@pytest.fixture(scope='session')
+def create_databases():
+    '''
+    The Databases/create-databases.py module, to run its migrations one at a time
+    '''
+    spec = importlib.util.spec_from_file_location('create_databases', os.path.join(ROOT, 'Databases', 'create-databases.py'))
+    create_databases = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(create_databases)
+    return create_databases
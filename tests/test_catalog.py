@@ -0,0 +1,50 @@
+import random
+
+from catalog import PlaceCatalog, read_places, export_snapshot, read_snapshot
+from data_scraper import get_connection, insert_places_batch, query_candidates, time_spent_per_type
+
+def test_select_loads_places_written_after_the_catalog(new_place):
+    catalog = PlaceCatalog(time_spent_per_type)
+    catalog.upsert(*read_places())
+
+    # Written by another process: the catalog isn't refreshed
+    city_id = get_connection().execute("SELECT id FROM cities").fetchone()[0]
+    insert_places_batch(city_id, [new_place('test-new-place', ['museum', 'park'])])
+
+    place_ids = [row[0] for row in get_connection().execute("SELECT place_id FROM places")]
+    for filters_including, filters_excluding in [([], []), (['museum'], []), ([], ['park']), ([], ['night_club'])]:
+        expected = query_candidates(place_ids, filters_including, filters_excluding, 3)
+        assert catalog.select(place_ids, filters_including, filters_excluding, 3) == expected
+    assert 'test-new-place' in [row[0] for row in catalog.select(['test-new-place'], [], [], 3)]
+
+def test_incremental_upserts_match_a_full_load(tmp_path):
+    rng = random.Random(0)
+    categories = ['park', 'museum', 'zoo', 'bar', 'casino']
+    places = {}
+
+    catalog = PlaceCatalog(time_spent_per_type)
+    for step in range(200):
+        rows, place_categories = [], []
+        for place_id in set([f'place-{rng.randint(0, 300)}' for _ in range(rng.randint(1, 20))]):
+            row = (place_id, f'{place_id}-{step}', rng.uniform(25, 25.3), rng.uniform(55, 55.4), rng.choice([None, 0, 2, 4]),
+                   rng.choice([None, 4.5]), rng.choice([None, 480]), rng.choice([None, 1020]), rng.choice([None, 30]))
+            places[place_id] = (row, rng.sample(categories, rng.randint(0, 3)))
+            rows.append(row)
+            place_categories += [(place_id, category) for category in places[place_id][1]]
+        catalog.upsert(rows, place_categories)
+
+        # Updates copy the arrays out of a snapshot
+        if step == 100:
+            export_snapshot(catalog, tmp_path / 'catalog.snapshot')
+            catalog = read_snapshot(tmp_path / 'catalog.snapshot', time_spent_per_type)
+
+    full = PlaceCatalog(time_spent_per_type)
+    full.upsert([places[place_id][0] for place_id in catalog.place_ids],
+                [(place_id, category) for place_id in catalog.place_ids for category in places[place_id][1]])
+
+    place_ids = list(places)
+    for _ in range(100):
+        subset = rng.sample(place_ids, rng.randint(0, len(place_ids)))
+        filters_including, filters_excluding = rng.sample(categories, rng.randint(0, 2)), rng.sample(categories, rng.randint(0, 2))
+        budget_level = rng.choice([1, 3, 5])
+        assert catalog.select(subset, filters_including, filters_excluding, budget_level) == full.select(subset, filters_including, filters_excluding, budget_level)
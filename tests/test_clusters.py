@@ -0,0 +1,45 @@
+import random
+
+import numpy as np
+import pytest
+
+from routing_basic import cluster_by_day
+
+def place_ids(places, clusters):
+    return sorted(sorted(places[i][0] for i in cluster) for cluster in clusters)
+
+@pytest.mark.parametrize('num_days', [1, 2, 3, 5])
+def test_every_place_is_in_one_cluster(hotel, trip_places, num_days):
+    places = trip_places()[:40]
+    clusters = cluster_by_day(hotel, places, num_days, 0)
+
+    assert len(clusters) == num_days
+    assert sorted(np.concatenate(clusters).tolist()) == list(range(len(places)))
+    # Sectors of equal weight
+    sizes = [len(cluster) for cluster in clusters]
+    assert max(sizes) - min(sizes) <= 1
+
+def test_required_places_are_spread_between_the_days(hotel, trip_places):
+    places = trip_places()[:40]
+    num_required, num_days = 6, 3
+    clusters = cluster_by_day(hotel, places, num_days, num_required)
+
+    assert sorted(np.concatenate(clusters).tolist()) == list(range(len(places)))
+    assert [int(np.sum(cluster < num_required)) for cluster in clusters] == [2, 2, 2]
+
+def test_no_places(hotel):
+    clusters = cluster_by_day(hotel, [], 3, 0)
+    assert len(clusters) == 3 and all(len(cluster) == 0 for cluster in clusters)
+
+def test_clusters_are_deterministic(hotel, trip_places):
+    places = trip_places()[:40]
+    num_required = 4
+    clusters = cluster_by_day(hotel, places, 3, num_required)
+    assert all(np.array_equal(a, b) for a, b in zip(clusters, cluster_by_day(hotel, places, 3, num_required)))
+
+    # The same days whatever the order the places come in
+    required, optional = places[:num_required], places[num_required:]
+    random.Random(0).shuffle(required)
+    random.Random(1).shuffle(optional)
+    shuffled = required + optional
+    assert place_ids(shuffled, cluster_by_day(hotel, shuffled, 3, num_required)) == place_ids(places, clusters)
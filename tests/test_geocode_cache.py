@@ -0,0 +1,41 @@
+import data_scraper
+from data_scraper import GEOCODE_TTL, geocode_key, geocode_memory, get_city_country, get_connection, reverse_geocode
+
+def geocode_requests():
+    return len(data_scraper.gmaps.latencies.get('reverse_geocode', []))
+
+def test_both_call_sites_share_the_cache():
+    requests = geocode_requests()
+    city, country = get_city_country('12.3456789', '45.6789012')
+    assert geocode_requests() == requests + 1
+
+    # Coordinates are rounded to GEOCODE_DECIMALS, strings from the form and floats share the key
+    assert reverse_geocode(12.34568, 45.67890)[0]['place_id']
+    assert get_city_country(12.345681, 45.678901) == (city, country)
+    assert geocode_requests() == requests + 1
+
+def test_results_survive_a_restart():
+    result = reverse_geocode(-12.5, 33.25)
+    requests = geocode_requests()
+
+    geocode_memory.clear()
+    assert reverse_geocode(-12.5, 33.25) == result
+    assert geocode_requests() == requests
+    assert geocode_key(-12.5, 33.25) in geocode_memory
+
+def test_expired_results_are_fetched_again():
+    result = reverse_geocode(48.5, 2.25)
+    requests = geocode_requests()
+
+    # Fetched longer than GEOCODE_TTL ago, in memory and in the database
+    key = geocode_key(48.5, 2.25)
+    expired = geocode_memory[key][0] - GEOCODE_TTL - 1
+    geocode_memory[key] = (expired, geocode_memory[key][1])
+    conn = get_connection()
+    with conn:
+        conn.execute("UPDATE geocode_cache SET fetched_at = ? WHERE key = ?", (expired, key))
+
+    assert reverse_geocode(48.5, 2.25) == result
+    assert geocode_requests() == requests + 1
+    assert conn.execute("SELECT fetched_at FROM geocode_cache WHERE key = ?", (key,)).fetchone()[0] > expired
+    assert geocode_memory[key][0] > expired
@@ -0,0 +1,64 @@
+import threading
+import time
+
+from data_scraper import city_exists, city_scraped, get_connection, insert_city, insert_places_batch, update_city
+from ingest_queue import IngestQueue
+
+def test_concurrent_batches_insert_each_place_once(new_place):
+    city_id = get_connection().execute("SELECT id FROM cities").fetchone()[0]
+    batch = [new_place(f'test-race-{i}', ['museum']) for i in range(50)]
+
+    errors = []
+    def insert():
+        try:
+            insert_places_batch(city_id, batch)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=insert) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    counts = get_connection().execute("SELECT COUNT(*), COUNT(DISTINCT place_id) FROM places WHERE place_id LIKE 'test-race-%'").fetchone()
+    assert counts == (50, 50)
+    assert get_connection().execute("SELECT COUNT(*) FROM place_categories WHERE place_id LIKE 'test-race-%'").fetchone()[0] == 50
+
+def wait_for(ingest_queue, job_id, seconds=30):
+    deadline = time.time() + seconds
+    while ingest_queue.get(job_id)['status'] in ('queued', 'running') and time.time() < deadline:
+        time.sleep(0.05)
+    return ingest_queue.get(job_id)
+
+def test_unfinished_jobs_are_resumed_by_another_queue():
+    # Queued by a web worker that stops before running it
+    stopped = IngestQueue(update_city, workers=0)
+    city_id = insert_city('Resumed City', 'Testland')
+    job = stopped.submit(40.0, -70.0, 'Resumed City', 'Testland', city_id)
+    assert stopped.submit(40.0, -70.0, 'Resumed City', 'Testland', city_id)['id'] == job['id']
+
+    restarted = IngestQueue(update_city)
+    assert restarted.get(job['id'])['status'] == 'queued'
+    assert restarted.resume() >= 1
+
+    job = wait_for(restarted, job['id'])
+    assert job['status'] == 'done' and job['num_places'] > 0
+    assert stopped.get(job['id']) == job
+    assert city_scraped(city_exists('Resumed City', 'Testland')[0])
+
+def test_failed_city_is_queued_again():
+    def fail(lat, lng, city, country, city_id):
+        raise RuntimeError('Maps is down')
+
+    city_id = insert_city('Failed City', 'Testland')
+    failing = IngestQueue(fail)
+    job = wait_for(failing, failing.submit(40.0, -70.0, 'Failed City', 'Testland', city_id)['id'])
+    assert job['status'] == 'failed' and 'Maps is down' in job['error']
+    assert not city_scraped(city_id)
+
+    working = IngestQueue(lambda lat, lng, city, country, city_id: ['place'])
+    retry = working.submit(40.0, -70.0, 'Failed City', 'Testland', city_id)
+    assert retry['id'] != job['id']
+    assert wait_for(working, retry['id'])['status'] == 'done'
@@ -0,0 +1,53 @@
+import sqlite3
+
+import pytest
+
+from data_scraper import DEFAULT_WINDOW, WEEKDAYS, opening_window
+
+CLOSED = (0, 0, 0, 0)
+
+# time_details as clean_data builds them: one [place_id, {day: (open_hour, open_minute, close_hour, close_minute)}] per opening
+PLACES = {
+    'office': [['office', {day: (9, 0, 17, 0) if day not in ('Saturday', 'Sunday') else CLOSED}] for day in WEEKDAYS],
+    'split': [['split', {'Monday': (9, 0, 12, 0)}], ['split', {'Monday': (14, 0, 18, 0)}]] + [['split', {day: CLOSED}] for day in WEEKDAYS[1:]],
+    'open 24 hours': [['open 24 hours', {day: (0, 0, 23, 59)}] for day in WEEKDAYS],
+    'overnight': [['overnight', {day: (20, 0, 2, 0) if day in ('Friday', 'Saturday') else CLOSED}] for day in WEEKDAYS],
+    'until midnight': [['until midnight', {day: (18, 30, 0, 0)}] for day in WEEKDAYS],
+    'closed': [['closed', {day: CLOSED}] for day in WEEKDAYS],
+    'unknown': [['unknown', {day: (None, None, None, None)}] for day in WEEKDAYS],
+    'no hours': [],
+}
+
+@pytest.mark.parametrize('place_id, window', [
+    ('office', (540, 1020)),
+    ('split', (540, 1080)),
+    ('open 24 hours', (0, 1439)),
+    ('overnight', (1200, 1440)),        # the window of a day ends at midnight
+    ('until midnight', (1110, 1440)),
+    ('closed', (1440, 1440)),
+    ('unknown', DEFAULT_WINDOW),
+    ('no hours', DEFAULT_WINDOW),
+])
+def test_opening_window(place_id, window):
+    intervals, daily_window = opening_window(PLACES[place_id])
+    assert daily_window == window
+    assert all(0 <= start < end <= start + 1440 for start, end in intervals)
+
+def test_overnight_intervals_end_the_next_day():
+    intervals, _ = opening_window(PLACES['overnight'])
+    friday, saturday = 4 * 1440, 5 * 1440
+    assert intervals == [(friday + 1200, friday + 1440 + 120), (saturday + 1200, saturday + 1440 + 120)]
+
+def test_backfill_matches_opening_window(tmp_path, create_databases):
+    # Places scraped before the windows existed only have their time rows
+    create_databases.migrate(str(tmp_path / 'travel.db'))
+    conn = sqlite3.connect(tmp_path / 'travel.db')
+    conn.executemany("INSERT INTO places (place_id, name) VALUES (?, ?)", [(place_id, place_id) for place_id in PLACES])
+    conn.executemany("INSERT INTO time (day, open_hour, open_minute, close_hour, close_minute, place_id) VALUES (?, ?, ?, ?, ?, ?)",
+                     [(day,) + tuple(hours) + (place_id,) for place_id, time_details in PLACES.items() for _, opening_hours in time_details for day, hours in opening_hours.items()])
+    create_databases.backfill_opening_windows(conn.cursor())
+
+    for place_id, time_details in PLACES.items():
+        intervals, window = opening_window(time_details)
+        assert conn.execute("SELECT open_minute, close_minute FROM places WHERE place_id = ?", (place_id,)).fetchone() == window, place_id
+        assert sorted(conn.execute("SELECT start_minute, end_minute FROM opening_intervals WHERE place_id = ?", (place_id,))) == sorted(intervals), place_id
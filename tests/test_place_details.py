@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+import data_scraper
+from data_scraper import DAY, fields, get_connection, insert_places_batch, refresh_place_details, stale_fields
+
+PLACE_ID = 'SYN:1.0000,1.0000:20000:7' # a place of the synthetic client
+
+@pytest.fixture
+def place(new_place, monkeypatch):
+    '''
+    A place scraped just now, and the fields of every details request made for it
+    '''
+    conn = get_connection()
+    with conn:
+        conn.execute("DELETE FROM places WHERE place_id = ?", (PLACE_ID,))
+        conn.execute("DELETE FROM place_fields WHERE place_id = ?", (PLACE_ID,))
+    insert_places_batch(conn.execute("SELECT id FROM cities").fetchone()[0], [new_place(PLACE_ID, ['museum'])])
+
+    requests = []
+    place = data_scraper.gmaps.place
+    def spy(place_id, fields=None, **kwargs):
+        requests.append(list(fields))
+        return place(place_id, fields=fields, **kwargs)
+    monkeypatch.setattr(data_scraper.gmaps, 'place', spy)
+    return requests
+
+def age(field, seconds):
+    conn = get_connection()
+    with conn:
+        conn.execute("UPDATE place_fields SET fetched_at = ? WHERE place_id = ? AND field = ?", (int(time.time() - seconds), PLACE_ID, field))
+
+def test_fresh_places_are_not_fetched(place):
+    assert stale_fields(PLACE_ID) == []
+    assert refresh_place_details(PLACE_ID) == []
+    assert place == []
+
+def test_each_field_has_its_own_ttl(place):
+    age('rating', 30 * DAY + 60)            # TTL of 30 days
+    age('opening_hours', 6 * DAY)           # TTL of 7 days
+    age('name', 10 * 365 * DAY)             # never changes
+    assert stale_fields(PLACE_ID) == ['rating']
+
+    # Never fetched (scraped before place_fields existed)
+    with get_connection() as conn:
+        conn.execute("DELETE FROM place_fields WHERE place_id = ? AND field = 'url'", (PLACE_ID,))
+    assert stale_fields(PLACE_ID) == ['rating', 'url']
+
+def test_only_stale_fields_are_fetched(place):
+    age('rating', 31 * DAY)
+    age('opening_hours', 8 * DAY)
+
+    assert refresh_place_details(PLACE_ID) == ['rating', 'opening_hours']
+    assert place == [['rating', 'opening_hours']]
+    assert stale_fields(PLACE_ID) == []
+
+    # The fetched fields replace the scraped ones, the others are kept
+    conn = get_connection()
+    name, rating, open_minute = conn.execute("SELECT name, rating, open_minute FROM places WHERE place_id = ?", (PLACE_ID,)).fetchone()
+    assert name == PLACE_ID and rating is not None and open_minute is not None
+    assert conn.execute("SELECT COUNT(*) FROM time WHERE place_id = ?", (PLACE_ID,)).fetchone()[0] >= 7
+    assert len(fields) == conn.execute("SELECT COUNT(*) FROM place_fields WHERE place_id = ?", (PLACE_ID,)).fetchone()[0]
@@ -0,0 +1,60 @@
+import math
+
+import pytest
+
+from data_scraper import get_connection, insert_places_batch, places_within
+from distances import EARTH_R_METERS
+
+# Far from the places of travel.db (and from the other tests), where a degree of longitude is half a degree of latitude
+CENTER = (-60.0, -140.0)
+
+def offset(point, north_meters, east_meters):
+    lat, lng = point
+    return lat + math.degrees(north_meters / EARTH_R_METERS), lng + math.degrees(east_meters / (EARTH_R_METERS * math.cos(math.radians(lat))))
+
+@pytest.fixture(scope='module')
+def ring(new_place):
+    '''
+    Places just inside and just outside 1 km north, south, east and west of CENTER
+    '''
+    city_id = get_connection().execute("SELECT id FROM cities").fetchone()[0]
+    places = {}
+    for direction, (north, east) in {'north': (1, 0), 'south': (-1, 0), 'east': (0, 1), 'west': (0, -1)}.items():
+        for name, meters in [('inside', 990), ('outside', 1010)]:
+            place = new_place(f'test-ring-{direction}-{name}', ['park'])
+            place[0]['lat'], place[0]['lng'] = offset(CENTER, north * meters, east * meters)
+            places[place[0]['place_id']] = place
+    insert_places_batch(city_id, list(places.values()))
+    return places
+
+def test_radius_edges(ring):
+    assert sorted(places_within([CENTER], 1)) == sorted([place_id for place_id in ring if place_id.endswith('-inside')])
+    assert sorted(places_within([CENTER], 1.02)) == sorted(ring)
+    assert places_within([CENTER], 0.5) == []
+    assert places_within([], 1) == []
+
+def test_places_within_any_of_the_points(ring):
+    # 1 km west of the east ring, the others are 2 km away
+    east = offset(CENTER, 0, 1000)
+    assert sorted(places_within([east, (0, 0)], 0.1)) == ['test-ring-east-inside', 'test-ring-east-outside']
+
+def test_rtree_follows_the_places(ring):
+    conn = get_connection()
+    def indexed(place_id):
+        return conn.execute("SELECT r.min_lat, r.max_lat, r.min_lng, r.max_lng FROM places_rtree r JOIN places p ON p.id = r.id WHERE p.place_id = ?", (place_id,)).fetchone()
+
+    # The R*Tree stores 32 bit floats
+    lat, lng = ring['test-ring-north-inside'][0]['lat'], ring['test-ring-north-inside'][0]['lng']
+    assert indexed('test-ring-north-inside') == pytest.approx((lat, lat, lng, lng), abs=1e-4)
+    assert conn.execute("SELECT COUNT(*) FROM places WHERE lat IS NOT NULL").fetchone() == conn.execute("SELECT COUNT(*) FROM places_rtree").fetchone()
+
+    # Moved next to CENTER
+    with conn:
+        conn.execute("UPDATE places SET lat = ?, lng = ? WHERE place_id = 'test-ring-south-outside'", CENTER)
+    assert indexed('test-ring-south-outside') == pytest.approx((CENTER[0], CENTER[0], CENTER[1], CENTER[1]), abs=1e-4)
+    assert places_within([CENTER], 0.5) == ['test-ring-south-outside']
+
+    with conn:
+        conn.execute("DELETE FROM places WHERE place_id = 'test-ring-south-outside'")
+    assert places_within([CENTER], 0.5) == []
+    assert conn.execute("SELECT COUNT(*) FROM places WHERE lat IS NOT NULL").fetchone() == conn.execute("SELECT COUNT(*) FROM places_rtree").fetchone()
@@ -0,0 +1,33 @@
+from plan_cache import PlanCache
+
+def test_miss_starts_from_the_previous_plan():
+    calls = []
+    def router(required, optional, ranking_considered, transport_mode, days_traveled, previous_plan=None):
+        calls.append(previous_plan)
+        return [[f'day {day}'] for day in range(days_traveled)], 10, 20, days_traveled
+
+    plan_cache = PlanCache()
+    key, plan = plan_cache.get_or_compute(router, ['hotel'], ['museum'], False, 'car', 2)
+    assert calls == [None]
+
+    other_key, _ = plan_cache.get_or_compute(router, ['hotel'], ['museum'], False, 'car', 3, previous_key=key)
+    assert other_key != key
+    assert calls == [None, plan[0]]
+
+    # Looking up the previous plan isn't a hit
+    assert plan_cache.stats() == {'hits': 0, 'misses': 2, 'size': 2}
+    assert plan_cache.get_or_compute(router, ['hotel'], ['museum'], False, 'car', 3, previous_key=key)[0] == other_key
+    assert len(calls) == 2 and plan_cache.stats()['hits'] == 1
+
+def test_plans_without_places_are_not_cached(tmp_path):
+    outputs = [([], 0, 0, 0), ([[{'name': 'Hotel'}, {'name': 'Hotel'}]], 0, 0, 0), ([[{'name': 'Hotel'}, {'name': 'Museum'}, {'name': 'Hotel'}]], 10, 60, 1)]
+    def router(required, optional, ranking_considered, transport_mode, days_traveled):
+        return outputs.pop(0)
+
+    plan_cache = PlanCache(db_path=str(tmp_path / 'plans.db'))
+    for _ in range(3):
+        key, plan = plan_cache.get_or_compute(router, ['hotel'], ['museum'], False, 'car', 1)
+    assert plan[3] == 1 and outputs == []
+
+    # Only the last one was saved, it is served from the database after a restart
+    assert PlanCache(db_path=str(tmp_path / 'plans.db')).get(key) == plan
@@ -0,0 +1,91 @@
+import pytest
+
+import rate_limit
+from rate_limit import TokenBucket, call_with_retries
+
+class FakeClock:
+    '''
+    Stands in for the time module of rate_limit: sleeping moves the clock forward instantly
+    '''
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, 'time', clock)
+    return clock
+
+def test_bucket_allows_a_burst_then_the_rate(clock):
+    bucket = TokenBucket(10, capacity=5)
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.sleeps == []
+
+    # Empty: the next token comes 1/rate seconds later
+    bucket.acquire()
+    assert clock.sleeps == [pytest.approx(0.1)]
+    bucket.acquire(3)
+    assert clock.sleeps[1] == pytest.approx(0.3)
+
+def test_bucket_refills_up_to_its_capacity(clock):
+    bucket = TokenBucket(10, capacity=5)
+    bucket.acquire(5)
+
+    clock.now += 60
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.sleeps == []
+    bucket.acquire()
+    assert clock.sleeps == [pytest.approx(0.1)]
+
+def failing(errors, result='ok'):
+    calls = []
+    def func(*args, **kwargs):
+        calls.append((args, kwargs))
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    return func, calls
+
+def test_retries_with_exponential_backoff(clock):
+    func, calls = failing([TimeoutError(), TimeoutError(), TimeoutError()])
+    tokens = []
+    class Bucket:
+        def acquire(self):
+            tokens.append(len(calls))
+
+    assert call_with_retries(func, 'place', retries=3, backoff=0.5, bucket=Bucket(), fields=['name']) == 'ok'
+    assert calls == [(('place',), {'fields': ['name']})] * 4
+    assert tokens == [0, 1, 2, 3] # a token before every attempt
+
+    # backoff, 2 * backoff, 4 * backoff with a jitter of up to half of it
+    for sleep, wait in zip(clock.sleeps, [0.5, 1, 2]):
+        assert wait / 2 <= sleep <= wait
+    assert len(clock.sleeps) == 3
+
+def test_backoff_is_capped(clock):
+    func, calls = failing([TimeoutError()] * 6)
+    call_with_retries(func, retries=6, backoff=1, max_backoff=4)
+    assert len(clock.sleeps) == 6
+    assert all(sleep <= 4 for sleep in clock.sleeps) and clock.sleeps[-1] >= 2
+
+def test_gives_up_after_the_last_retry(clock):
+    func, calls = failing([TimeoutError()] * 10)
+    with pytest.raises(TimeoutError):
+        call_with_retries(func, retries=2)
+    assert len(calls) == 3 and len(clock.sleeps) == 2
+
+def test_errors_not_worth_retrying_are_raised_at_once(clock):
+    func, calls = failing([ValueError('INVALID_REQUEST')])
+    with pytest.raises(ValueError):
+        call_with_retries(func, should_retry=lambda error: isinstance(error, TimeoutError))
+    assert len(calls) == 1 and clock.sleeps == []
@@ -0,0 +1,67 @@
+import pytest
+
+import catalog
+from routing_basic import router, SOLVE_BUDGET
+from data_scraper import time_spent_per_type
+
+# Small budget so the suite runs quickly, the search still gets to plateau
+BUDGET = dict(SOLVE_BUDGET, max_seconds=4, plateau_seconds=1)
+
+@pytest.fixture(scope='module')
+def places(trip_places):
+    return trip_places()
+
+def solve(required, optional, transport_mode, days, previous_plan=None, ranking_considered=False):
+    solve_stats = {}
+    output = router(required, optional, ranking_considered, transport_mode, days, budget=BUDGET, solve_stats=solve_stats, previous_plan=previous_plan)
+    return output, solve_stats
+
+@pytest.mark.parametrize('source', ['database', 'catalog'])
+def test_router_solves_get_routes_simple_output(source, hotel, trip_places):
+    # Visit times averaged over categories (e.g. 112.5 minutes) have to reach the solver as whole minutes
+    if source == 'catalog':
+        catalog.load_catalog(time_spent_per_type)
+    try:
+        places = trip_places()
+    finally:
+        catalog._catalog = None
+
+    assert all(isinstance(place[6], int) for place in places)
+
+    required, optional = [hotel] + places[:2], places[2:30]
+    (plan, travel_time, visit_time, num_sites), solve_stats = solve(required, optional, 'car', 3)
+
+    assert solve_stats['objective'] is not None
+    assert num_sites >= 2
+    assert all(isinstance(stop['visit_time'], int) for day_plan in plan for stop in day_plan)
+
+@pytest.mark.parametrize('change', ['more days', 'fewer days', 'new required place', 'removed place', 'other transport', 'ranking'])
+def test_warm_start_is_faster_than_cold_start(places, hotel, change):
+    required, optional, days, ranking_considered = [hotel] + places[:2], places[2:25], 3, False
+    # The previous plan has to stay feasible, a walking plan is also feasible by car
+    transport_mode = 'walking' if change == 'other transport' else 'car'
+    (plan, _, _, _), _ = solve(required, optional, transport_mode, days)
+
+    if change == 'more days':
+        days = 4
+    elif change == 'fewer days':
+        days = 2
+    elif change == 'new required place':
+        required, optional = required + optional[:1], optional[1:]
+    elif change == 'removed place':
+        optional = optional[:5] + optional[6:]
+    elif change == 'other transport':
+        transport_mode = 'car'
+    elif change == 'ranking':
+        ranking_considered = True
+
+    _, warm_stats = solve(required, optional, transport_mode, days, previous_plan=plan, ranking_considered=ranking_considered)
+    _, cold_stats = solve(required, optional, transport_mode, days, ranking_considered=ranking_considered)
+
+    # The metaheuristic keeps searching from the previous plan until it plateaus, which comes much sooner
+    # than for a search from scratch, and the plan is as good
+    assert warm_stats['warm_started']
+    assert warm_stats['stop_reason'] == 'plateau'
+    assert cold_stats['stop_reason'] in ('plateau', 'time_limit')
+    assert warm_stats['solve_seconds'] < cold_stats['solve_seconds'] * 0.75
+    assert warm_stats['objective'] <= cold_stats['objective'] * 1.05
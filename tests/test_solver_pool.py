@@ -0,0 +1,25 @@
+import pytest
+
+from routing_basic import SOLVE_BUDGET
+from solver_pool import SolverExecutor, SolverTimeout
+
+@pytest.fixture
+def solver():
+    solver = SolverExecutor(max_workers=2, timeout=60)
+    yield solver
+    solver.shutdown()
+
+def test_timeout_only_abandons_its_own_job(solver, hotel, trip_places):
+    places = trip_places()
+    required, optional = [hotel] + places[:2], places[2:25]
+
+    # Both jobs run at the same time, the first one searches for longer than its timeout
+    other_job = solver.submit(required, optional, False, 'car', 3, budget=dict(SOLVE_BUDGET, max_seconds=8, plateau_seconds=8))
+    with pytest.raises(SolverTimeout):
+        solver.solve(required, optional, False, 'car', 3, timeout=3, budget=dict(SOLVE_BUDGET, base_seconds=30, max_seconds=30, plateau_seconds=30))
+
+    (plan, travel_time, visit_time, num_sites), solve_stats = other_job.result(timeout=60)
+    assert solve_stats['objective'] is not None
+
+    # The abandoned job's worker is replaced
+    assert solver.solve(required, optional, False, 'car', 3, budget=dict(SOLVE_BUDGET, max_seconds=2, plateau_seconds=1))[0]
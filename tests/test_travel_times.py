@@ -0,0 +1,40 @@
+import numpy as np
+
+import data_scraper
+import routing_basic
+from routing_basic import compute_distance_matrix, compute_time_matrix, compute_travel_matrices
+
+def distance_matrix_requests():
+    return len(data_scraper.gmaps.latencies.get('distance_matrix', []))
+
+def trip_locations(hotel, num_places):
+    rows = data_scraper.get_connection().execute("SELECT place_id, lat, lng FROM places ORDER BY id LIMIT ?", (num_places,)).fetchall()
+    return ['HOTEL'] + [row[0] for row in rows], [(hotel[2], hotel[3])] + [(row[1], row[2]) for row in rows]
+
+def test_haversine_travel_times_dont_touch_the_cache(hotel):
+    place_ids, locations = trip_locations(hotel, 10)
+    requests = distance_matrix_requests()
+
+    distance_matrix, time_matrix = compute_travel_matrices(place_ids, locations, 'car')
+
+    assert distance_matrix_requests() == requests
+    assert np.array_equal(distance_matrix, compute_distance_matrix(locations))
+    assert np.array_equal(time_matrix, compute_time_matrix('car', distance_matrix))
+
+def test_google_travel_times_are_fetched_once(monkeypatch, hotel):
+    monkeypatch.setattr(routing_basic, 'GOOGLE_TRAVEL_TIMES', True)
+    place_ids, locations = trip_locations(hotel, 30)
+    requests = distance_matrix_requests()
+
+    distance_matrix, time_matrix = compute_travel_matrices(place_ids, locations, 'walking')
+    assert distance_matrix_requests() > requests
+
+    # Roads of the synthetic client are longer than the straight line, the hotel keeps its estimates
+    haversine = compute_distance_matrix(locations)
+    assert (distance_matrix[1:, 1:] >= haversine[1:, 1:]).all() and (distance_matrix[1:, 1:] > haversine[1:, 1:]).any()
+    assert np.array_equal(distance_matrix[0], haversine[0])
+
+    # Every pair is read from travel_times now
+    requests = distance_matrix_requests()
+    assert all(np.array_equal(a, b) for a, b in zip(compute_travel_matrices(place_ids, locations, 'walking'), (distance_matrix, time_matrix)))
+    assert distance_matrix_requests() == requests